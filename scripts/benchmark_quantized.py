@@ -22,42 +22,73 @@ Usage:
 
 Requirements:
     pip install transformers torch sacrebleu evaluate datasets
+    pip install ijson  # optional: stream large test sets
+    pip install pyarrow  # optional: read Parquet test sets
 """
 
 import argparse
+import gc
 import json
 import os
 import sys
 import time
+from collections import Counter
 from datetime import datetime
+from functools import partial
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, Optional, Tuple
 
 import torch
 from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
 
+from tensor_bleu import tensor_bleu
+
+_RULE = "=" * 60
+
+
+def select_dtype(device: str) -> torch.dtype:
+    """Pick the inference dtype: BF16 where supported, else FP16 on CUDA, FP32 on CPU."""
+    if not device.startswith("cuda"):
+        return torch.float32
+    return torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+
 
 class TranslationBenchmark:
     """Benchmark translation quality and performance."""
 
-    def __init__(self, model_path: str, device: str = "cuda:0"):
+    def __init__(
+        self, model_path: str, device: str = "cuda:0", compile_model: bool = False
+    ):
         """Initialize with model and tokenizer."""
         self.device = device
         self.model_path = model_path
 
         print(f"Loading model from {model_path}...")
         self.tokenizer = AutoTokenizer.from_pretrained(model_path)
-        self.model = AutoModelForSeq2SeqLM.from_pretrained(
-            model_path,
-            torch_dtype=torch.float16 if device.startswith("cuda") else torch.float32,
-            device_map=device,
-        )
+        load_kwargs = {"torch_dtype": select_dtype(device), "device_map": device}
+        try:
+            self.model = AutoModelForSeq2SeqLM.from_pretrained(
+                model_path, attn_implementation="sdpa", **load_kwargs
+            )
+        except ValueError as e:
+            # Architectures without SDPA support refuse the kwarg; use their default
+            print(f"SDPA attention unavailable ({e}); using default attention")
+            self.model = AutoModelForSeq2SeqLM.from_pretrained(model_path, **load_kwargs)
         self.model.eval()
+        self.model.config.use_cache = True
 
-        # Get model size
-        self.model_size_gb = sum(p.numel() for p in self.model.parameters()) * 2 / (
-            1024**3
-        )
+        if compile_model:
+            # Compile forward only; generate() stays in Python and calls it per step
+            self.model.forward = torch.compile(
+                self.model.forward, mode="reduce-overhead", fullgraph=False
+            )
+
+        # Get model size from actual storage, so int8/int4 weights are not
+        # counted as 2 bytes each
+        total_bytes = sum(
+            p.numel() * p.element_size() for p in self.model.parameters()
+        ) + sum(b.numel() * b.element_size() for b in self.model.buffers())
+        self.model_size_gb = total_bytes / (1024**3)
         print(f"✅ Model loaded ({self.model_size_gb:.2f} GB)")
 
     def translate(
@@ -69,76 +100,219 @@ class TranslationBenchmark:
             text, return_tensors="pt", max_length=512, truncation=True
         ).to(self.device)
 
-        with torch.no_grad():
+        with torch.inference_mode():
             outputs = self.model.generate(
                 **inputs,
                 max_length=max_length,
                 num_beams=4,
                 early_stopping=True,
+                pad_token_id=self.tokenizer.pad_token_id,
             )
 
         return self.tokenizer.decode(outputs[0], skip_special_tokens=True)
 
+    def iter_translate(
+        self,
+        texts: List[str],
+        source_lang: str,
+        target_lang: str,
+        batch_size: int = 8,
+        max_length: int = 512,
+    ) -> Iterator[Tuple[List[int], List[str]]]:
+        """Translate texts batch by batch, yielding (indices, translations).
+
+        Texts are bucketed by tokenized length so each padded batch wastes as
+        few PAD positions as possible; ``indices`` map translations back to
+        their position in ``texts``. Each batch runs through a single
+        ``generate`` call.
+        """
+        if not texts:
+            return
+
+        # Tokenize once: the same ids drive both the length sort and generate
+        encoded = self.tokenizer(texts, max_length=512, truncation=True)
+        input_ids = encoded["input_ids"]
+        attention_mask = encoded["attention_mask"]
+        order = sorted(range(len(texts)), key=lambda idx: len(input_ids[idx]))
+
+        for i in range(0, len(order), batch_size):
+            indices = order[i : i + batch_size]
+            try:
+                inputs = self.tokenizer.pad(
+                    {
+                        "input_ids": [input_ids[idx] for idx in indices],
+                        "attention_mask": [attention_mask[idx] for idx in indices],
+                    },
+                    return_tensors="pt",
+                ).to(self.device)
+
+                with torch.inference_mode():
+                    outputs = self.model.generate(
+                        **inputs,
+                        max_length=max_length,
+                        num_beams=4,
+                        early_stopping=True,
+                        pad_token_id=self.tokenizer.pad_token_id,
+                    )
+
+                yield indices, self.tokenizer.batch_decode(
+                    outputs, skip_special_tokens=True
+                )
+            except Exception as e:
+                print(f"⚠️  Error translating batch {i // batch_size}: {e}")
+                yield indices, [""] * len(indices)
+
+    def token_bleu(self, predictions: List[str], references: List[str]) -> torch.Tensor:
+        """Per-sentence BLEU on token ids, computed on the model's device."""
+        encode = partial(
+            self.tokenizer, padding=True, add_special_tokens=False, return_tensors="pt"
+        )
+        candidates = encode(predictions).input_ids.to(self.device)
+        targets = encode(references).input_ids.to(self.device)
+        return tensor_bleu(candidates, targets, pad_id=self.tokenizer.pad_token_id)
+
     def batch_translate(
         self,
         texts: List[str],
         source_lang: str,
         target_lang: str,
         batch_size: int = 8,
+        max_length: int = 512,
     ) -> List[str]:
-        """Translate multiple texts in batches."""
-        results = []
-        for i in range(0, len(texts), batch_size):
-            batch = texts[i : i + batch_size]
-            for text in batch:
-                try:
-                    result = self.translate(text, source_lang, target_lang)
-                    results.append(result)
-                except Exception as e:
-                    print(f"⚠️  Error translating '{text[:50]}': {e}")
-                    results.append("")
+        """Translate multiple texts in batches, preserving input order."""
+        results = [""] * len(texts)
+        for indices, translations in self.iter_translate(
+            texts, source_lang, target_lang, batch_size, max_length
+        ):
+            for idx, translation in zip(indices, translations):
+                results[idx] = translation
 
         return results
 
 
-def compute_bleu_score(references: List[str], predictions: List[str]) -> float:
-    """Compute BLEU score using sacrebleu."""
-    try:
-        from sacrebleu import corpus_bleu
-
-        # Format for sacrebleu
-        refs = [[ref] for ref in references]
-        bleu = corpus_bleu(predictions, refs)
-        return bleu.score / 100.0  # Normalize to 0-1
-    except ImportError:
-        print("⚠️  sacrebleu not installed, using approximate score")
-        # Fallback: simple word overlap
-        correct = sum(
-            1
-            for ref, pred in zip(references, predictions)
-            if ref.lower().strip() == pred.lower().strip()
+class BleuAccumulator:
+    """Accumulate corpus BLEU statistics incrementally, one batch at a time.
+
+    Uses sacrebleu sufficient statistics when available, otherwise falls back
+    to corpus-level clipped unigram precision.
+    """
+
+    def __init__(self):
+        try:
+            from sacrebleu.metrics import BLEU
+
+            self._bleu = BLEU(effective_order=True)
+        except ImportError:
+            print("⚠️  sacrebleu not installed, using approximate score")
+            self._bleu = None
+
+        self._correct = [0, 0, 0, 0]
+        self._total = [0, 0, 0, 0]
+        self._sys_len = 0
+        self._ref_len = 0
+
+    def update(self, predictions: List[str], references: List[str]) -> None:
+        """Add a batch of prediction/reference pairs."""
+        for pred, ref in zip(predictions, references):
+            if self._bleu is None:
+                pred_counts = Counter(pred.lower().split())
+                self._correct[0] += sum(
+                    (pred_counts & Counter(ref.lower().split())).values()
+                )
+                self._total[0] += sum(pred_counts.values())
+                continue
+
+            stats = self._bleu.sentence_score(pred, [ref])
+            for n in range(4):
+                self._correct[n] += stats.counts[n]
+                self._total[n] += stats.totals[n]
+            self._sys_len += stats.sys_len
+            self._ref_len += stats.ref_len
+
+    def score(self) -> float:
+        """Return the corpus score normalized to 0-1."""
+        if self._bleu is None:
+            return self._correct[0] / self._total[0] if self._total[0] else 0.0
+
+        from sacrebleu.metrics import BLEU
+
+        bleu = BLEU.compute_bleu(
+            self._correct,
+            self._total,
+            self._sys_len,
+            self._ref_len,
+            smooth_method="exp",
         )
-        return correct / len(references) if references else 0.0
-
+        return bleu.score / 100.0  # Normalize to 0-1
 
-def load_test_set(test_file: str) -> List[Dict[str, Any]]:
-    """Load test dataset from JSON file."""
-    with open(test_file, "r") as f:
-        data = json.load(f)
 
-    if isinstance(data, dict):
-        # Assume it has 'samples' or similar key
-        return data.get("samples", [])
-    else:
-        return data
+def compute_bleu_score(references: List[str], predictions: List[str]) -> float:
+    """Compute corpus BLEU score using sacrebleu."""
+    bleu = BleuAccumulator()
+    bleu.update(predictions, references)
+    return bleu.score()
+
+
+def _is_wrapped(f: BinaryIO) -> bool:
+    """Peek at the first JSON token: ``{`` means a ``{"samples": [...]}`` file."""
+    head = f.read(64).lstrip()
+    f.seek(0)
+    return head.startswith(b"{")
+
+
+def load_test_set(test_file: str) -> Iterator[Dict[str, Any]]:
+    """Stream test samples from a JSON file.
+
+    Uses ijson to yield samples one at a time when installed, so large eval
+    files are never fully materialized; falls back to ``json.load`` otherwise.
+    Samples written as ``pool_ref`` indices into ``samples_pool`` (the
+    prepare_eval_set.py default) are resolved to their source/reference text.
+    Parquet suites are read one record batch at a time via pyarrow.
+    """
+    if test_file.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(test_file).iter_batches():
+            for sample in batch.to_pylist():
+                if sample.get("source") is not None:
+                    yield sample
+        return
+
+    with open(test_file, "rb") as f:
+        wrapped = _is_wrapped(f)
+        try:
+            import ijson
+
+            pool = list(ijson.items(f, "samples_pool.item")) if wrapped else []
+            f.seek(0)
+            samples = ijson.items(f, "samples.item" if wrapped else "item")
+        except ImportError:
+            data = json.load(f)
+            # Assume it has 'samples' or similar key
+            pool = data.get("samples_pool", []) if wrapped else []
+            samples = data.get("samples", []) if wrapped else data
+
+        for sample in samples:
+            if "pool_ref" in sample:
+                sample = {**pool[sample["pool_ref"]], **sample}
+            if "source" not in sample:
+                continue
+            yield sample
 
 
 def evaluate_model(
     model: TranslationBenchmark,
-    test_set: List[Dict[str, Any]],
+    test_set: Iterable[Dict[str, Any]],
     languages: Optional[List[str]] = None,
+    batch_size: int = 8,
+    token_bleu: bool = False,
 ) -> Dict[str, Any]:
-    """Evaluate model on test set."""
+    """
+    Evaluate model on test set.
+
+    With ``token_bleu`` each pair also reports the mean per-sentence BLEU on
+    token ids (tensor_bleu), which is cheap and meant for relative comparisons.
+    """
     results = {
         "model_size_gb": model.model_size_gb,
         "timestamp": datetime.now().isoformat(),
@@ -157,7 +331,8 @@ def evaluate_model(
             pairs[pair] = []
         pairs[pair].append(sample)
 
-    print(f"\nEvaluating {len(pairs)} language pairs...")
+    num_samples = sum(len(samples) for samples in pairs.values())
+    print(f"\nEvaluating {num_samples} samples across {len(pairs)} language pairs...")
 
     for (src_lang, tgt_lang), samples in pairs.items():
         pair_name = f"{src_lang}→{tgt_lang}"
@@ -169,11 +344,24 @@ def evaluate_model(
 
         print(f"  Translating {len(sources)} sentences...")
         start_time = time.time()
-        predictions = model.batch_translate(sources, src_lang, tgt_lang)
+        bleu_acc = BleuAccumulator()
+        token_bleu_sum = 0.0
+        sample_predictions = [""] * min(3, len(sources))
+        for indices, translations in model.iter_translate(
+            sources, src_lang, tgt_lang, batch_size=batch_size
+        ):
+            # Fold each batch into BLEU statistics; only the first few
+            # predictions are retained for the report
+            batch_refs = [references[idx] for idx in indices]
+            bleu_acc.update(translations, batch_refs)
+            if token_bleu:
+                token_bleu_sum += model.token_bleu(translations, batch_refs).sum().item()
+            for idx, translation in zip(indices, translations):
+                if idx < len(sample_predictions):
+                    sample_predictions[idx] = translation
         elapsed = time.time() - start_time
 
-        # Compute BLEU
-        bleu = compute_bleu_score(references, predictions)
+        bleu = bleu_acc.score()
         avg_latency = (elapsed * 1000) / len(sources) if sources else 0
 
         results["language_pairs"][pair_name] = {
@@ -187,17 +375,24 @@ def evaluate_model(
                     "reference": ref,
                     "prediction": pred,
                 }
-                for src, ref, pred in zip(sources[:3], references[:3], predictions[:3])
+                for src, ref, pred in zip(sources, references, sample_predictions)
             ],
         }
 
         print(f"  ✅ BLEU: {bleu:.4f}")
+        if token_bleu:
+            pair_token_bleu = token_bleu_sum / len(sources) if sources else 0.0
+            results["language_pairs"][pair_name]["token_bleu"] = pair_token_bleu
+            print(f"  ✅ Token BLEU: {pair_token_bleu:.4f}")
         print(f"  ✅ Latency: {avg_latency:.1f}ms/sentence")
 
     # Compute overall metrics
     all_bleus = [m["bleu_score"] for m in results["language_pairs"].values()]
     results["overall_metrics"]["mean_bleu"] = sum(all_bleus) / len(all_bleus)
     results["overall_metrics"]["num_language_pairs"] = len(all_bleus)
+    if token_bleu:
+        token_bleus = [m["token_bleu"] for m in results["language_pairs"].values()]
+        results["overall_metrics"]["mean_token_bleu"] = sum(token_bleus) / len(token_bleus)
 
     return results
 
@@ -277,7 +472,7 @@ Examples:
     parser.add_argument(
         "--test_set",
         default="./eval/translate_gemma_test_suite.json",
-        help="Path to test set JSON file",
+        help="Path to test set JSON or Parquet file",
     )
     parser.add_argument(
         "--output_dir",
@@ -300,15 +495,25 @@ Examples:
         default=8,
         help="Batch size for translation",
     )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="Wrap model forward in torch.compile (first batch pays compile cost)",
+    )
+    parser.add_argument(
+        "--token_bleu",
+        action="store_true",
+        help="Also report per-sentence BLEU on token ids, computed on the device",
+    )
 
     args = parser.parse_args()
 
     # Create output directory
     os.makedirs(args.output_dir, exist_ok=True)
 
-    print(f"{'='*60}")
+    print(f"{_RULE}")
     print(f"  TranslateGemma Quantization Benchmark")
-    print(f"{'='*60}\n")
+    print(f"{_RULE}\n")
 
     # Check test set exists
     if not os.path.exists(args.test_set):
@@ -316,17 +521,20 @@ Examples:
         print(f"Create test set first with: python prepare_eval_set.py")
         sys.exit(1)
 
-    test_set = load_test_set(args.test_set)
-    print(f"✅ Loaded test set with {len(test_set)} samples")
-
     # Evaluate quantized model
-    print(f"\n{'='*60}")
+    print(f"\n{_RULE}")
     print(f"Evaluating Quantized Model")
-    print(f"{'='*60}")
+    print(f"{_RULE}")
 
-    quantized_model = TranslationBenchmark(args.model, device=args.device)
+    quantized_model = TranslationBenchmark(
+        args.model, device=args.device, compile_model=args.compile
+    )
     quantized_results = evaluate_model(
-        quantized_model, test_set, languages=args.languages
+        quantized_model,
+        load_test_set(args.test_set),
+        languages=args.languages,
+        batch_size=args.batch_size,
+        token_bleu=args.token_bleu,
     )
 
     # Save quantized results
@@ -335,15 +543,28 @@ Examples:
         json.dump(quantized_results, f, indent=2)
     print(f"\n✅ Saved quantized results to {quantized_file}")
 
+    # Release the quantized model before loading the baseline so both are
+    # never resident on the device at once
+    del quantized_model
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
     # Evaluate baseline if provided
     if args.baseline:
-        print(f"\n{'='*60}")
+        print(f"\n{_RULE}")
         print(f"Evaluating Baseline Model")
-        print(f"{'='*60}")
+        print(f"{_RULE}")
 
-        baseline_model = TranslationBenchmark(args.baseline, device=args.device)
+        baseline_model = TranslationBenchmark(
+            args.baseline, device=args.device, compile_model=args.compile
+        )
         baseline_results = evaluate_model(
-            baseline_model, test_set, languages=args.languages
+            baseline_model,
+            load_test_set(args.test_set),
+            languages=args.languages,
+            batch_size=args.batch_size,
+            token_bleu=args.token_bleu,
         )
 
         # Save baseline results
@@ -353,9 +574,9 @@ Examples:
         print(f"\n✅ Saved baseline results to {baseline_file}")
 
         # Compare
-        print(f"\n{'='*60}")
+        print(f"\n{_RULE}")
         print(f"Comparison: Baseline vs Quantized")
-        print(f"{'='*60}\n")
+        print(f"{_RULE}\n")
 
         comparison = compare_results(baseline_results, quantized_results)
 
@@ -384,9 +605,9 @@ Examples:
             json.dump(comparison, f, indent=2)
         print(f"\n✅ Saved comparison to {comparison_file}")
 
-    print(f"\n{'='*60}")
+    print(f"\n{_RULE}")
     print(f"Results saved to: {args.output_dir}")
-    print(f"{'='*60}\n")
+    print(f"{_RULE}\n")
 
 
 if __name__ == "__main__":
@@ -13,18 +13,31 @@ Usage:
 
 Requirements:
     pip install datasets
+    pip install orjson  # optional: faster JSON output
+    pip install pyarrow  # optional: Parquet output
 """
 
 import argparse
+import itertools
 import json
-import os
 import random
+import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-from typing import Dict, List, Optional, Tuple
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
 
-# Sample multilingual test data
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_RULE = "=" * 60
+
+# Sample multilingual test data, stored as tuples since it is never mutated
 SAMPLE_TRANSLATIONS = {
-    "en_zh": [
+    "en_zh": (
         {
             "source": "Hello, how are you today?",
             "reference": "你好，你今天好吗？",
@@ -45,8 +58,8 @@ SAMPLE_TRANSLATIONS = {
             "source": "Thank you for your help yesterday.",
             "reference": "感谢你昨天的帮助。",
         },
-    ],
-    "en_es": [
+    ),
+    "en_es": (
         {
             "source": "Good morning, how are you?",
             "reference": "Buenos días, ¿cómo estás?",
@@ -67,8 +80,8 @@ SAMPLE_TRANSLATIONS = {
             "source": "The restaurant serves excellent food.",
             "reference": "El restaurante sirve comida excelente.",
         },
-    ],
-    "en_fr": [
+    ),
+    "en_fr": (
         {
             "source": "Bonjour, comment allez-vous?",
             "reference": "Hello, how are you?",
@@ -89,8 +102,8 @@ SAMPLE_TRANSLATIONS = {
             "source": "What time does the museum close?",
             "reference": "À quelle heure le musée ferme-t-il?",
         },
-    ],
-    "en_de": [
+    ),
+    "en_de": (
         {
             "source": "Good day, how are you?",
             "reference": "Guten Tag, wie geht es dir?",
@@ -111,8 +124,8 @@ SAMPLE_TRANSLATIONS = {
             "source": "Do you speak English?",
             "reference": "Sprichst du Englisch?",
         },
-    ],
-    "en_ja": [
+    ),
+    "en_ja": (
         {
             "source": "Hello, what is your name?",
             "reference": "こんにちは、あなたの名前は何ですか？",
@@ -133,8 +146,8 @@ SAMPLE_TRANSLATIONS = {
             "source": "What time is the train?",
             "reference": "電車は何時ですか？",
         },
-    ],
-    "en_ko": [
+    ),
+    "en_ko": (
         {
             "source": "Hello, nice to meet you.",
             "reference": "안녕하세요, 만나서 반갑습니다.",
@@ -155,36 +168,159 @@ SAMPLE_TRANSLATIONS = {
             "source": "How much does this cost?",
             "reference": "이것은 얼마예요?",
         },
-    ],
+    ),
+}
+
+# Below this many samples, process start-up and pickling cost more than the
+# per-pair work saved by create_synthetic_test_set running pairs in parallel
+PARALLEL_MIN_SAMPLES = 200_000
+
+# Reverse-direction samples (e.g. "zh_en" from "en_zh"), swapped once at import
+_REVERSED_SAMPLES = {
+    f"{tgt_lang}_{src_lang}": tuple(
+        {"source": s["reference"], "reference": s["source"]} for s in samples
+    )
+    for key, samples in SAMPLE_TRANSLATIONS.items()
+    for src_lang, tgt_lang in (key.split("_"),)
 }
 
 
-def load_flores200_data(languages: List[str]) -> Dict[str, List[Dict]]:
+def write_json(path: str, data: Any, compact: bool = False) -> None:
+    """
+    Write data as UTF-8 JSON, using orjson when installed.
+
+    Output is indented unless ``compact``. Non-ASCII text is written as-is
+    rather than \\u-escaped, which matters for CJK-heavy test sets.
+    """
+    if orjson is not None:
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(data, option=0 if compact else orjson.OPT_INDENT_2))
+        return
+
+    with open(path, "w", encoding="utf-8") as f:
+        if compact:
+            json.dump(data, f, separators=(",", ":"), ensure_ascii=False)
+        else:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+
+
+# FLORES+ language configs for the short codes accepted on the command line
+FLORES_CODES = {
+    "en": "eng_Latn",
+    "zh": "cmn_Hans",
+    "es": "spa_Latn",
+    "fr": "fra_Latn",
+    "de": "deu_Latn",
+    "ja": "jpn_Jpan",
+    "ko": "kor_Hang",
+    "ar": "arb_Arab",
+    "hi": "hin_Deva",
+    "ru": "rus_Cyrl",
+}
+
+
+def write_parquet(path: str, test_set: List[Dict], metadata: Dict[str, Any]) -> None:
+    """
+    Write samples as a zstd-compressed Parquet table.
+    Requires: pip install pyarrow
+
+    Metadata values are stored JSON-encoded in the Arrow schema metadata.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        print("❌ pyarrow not installed. Install with:")
+        print("   pip install pyarrow")
+        sys.exit(1)
+
+    # Union of keys across rows: edge cases carry an extra description column
+    columns = dict.fromkeys(key for sample in test_set for key in sample)
+    table = pa.table({key: [sample.get(key) for sample in test_set] for key in columns})
+    table = table.replace_schema_metadata(
+        {key: json.dumps(value) for key, value in metadata.items()}
+    )
+    pq.write_table(table, path, compression="zstd")
+
+
+def load_flores200_data(
+    languages: List[str], samples_per_lang: int, split: str = "devtest"
+) -> Dict[str, List[str]]:
     """
     Load FLORES-200 benchmark data.
     Requires: pip install datasets
 
-    FLORES-200 has 1000 parallel sentences for each language pair.
+    Streams only the requested languages from FLORES+ (the maintained
+    FLORES-200 successor) and stops after samples_per_lang sentences, instead
+    of downloading every language. Sentences are aligned by position across
+    languages.
     """
     try:
         from datasets import load_dataset
+    except ImportError:
+        print("⚠️  datasets library not installed")
+        print("   Install with: pip install datasets")
+        return {}
 
-        print("Loading FLORES-200 dataset...")
+    print(f"Streaming FLORES+ {split} split...")
+
+    data = {}
+    for lang in languages:
+        config = FLORES_CODES.get(lang)
+        if config is None:
+            print(f"⚠️  No FLORES+ code for '{lang}', skipping")
+            continue
 
-        # FLORES-200 typically has splits: dev, devtest
         try:
-            data = load_dataset("facebook/flores", "all")
+            stream = load_dataset(
+                "openlanguagedata/flores_plus", config, split=split, streaming=True
+            )
+            data[lang] = [
+                row["text"] for row in itertools.islice(stream, samples_per_lang)
+            ]
         except Exception as e:
-            print(f"⚠️  Could not load FLORES-200: {e}")
+            print(f"⚠️  Could not load FLORES+ for {lang} ({config}): {e}")
             return {}
 
-        print(f"✅ FLORES-200 loaded")
-        return data
+    print(f"✅ FLORES+ loaded for {len(data)} languages")
+    return data
+
+
+def create_flores_test_set(flores_data: Dict[str, List[str]]) -> List[Dict]:
+    """Pair aligned FLORES sentences across every language combination."""
+    test_set = []
+    for src_lang, tgt_lang in itertools.permutations(flores_data, 2):
+        for source, reference in zip(flores_data[src_lang], flores_data[tgt_lang]):
+            test_set.append(
+                {
+                    "id": len(test_set),
+                    "source_lang": src_lang,
+                    "target_lang": tgt_lang,
+                    "source": source,
+                    "reference": reference,
+                }
+            )
+    return test_set
 
-    except ImportError:
-        print("⚠️  datasets library not installed")
-        print("   Install with: pip install datasets")
-        return {}
+
+def _build_pair(job: Tuple[str, str, int]) -> List[Dict]:
+    """Build the samples for one language pair; ids are assigned by the caller."""
+    src_lang, tgt_lang, samples_per_lang = job
+    pair_key = f"{src_lang}_{tgt_lang}"
+    samples = (
+        SAMPLE_TRANSLATIONS.get(pair_key) or _REVERSED_SAMPLES.get(pair_key) or ()
+    )
+
+    # Cycle samples to reach target count
+    return [
+        {
+            "source_lang": src_lang,
+            "target_lang": tgt_lang,
+            "source": sample.get("source", ""),
+            "reference": sample.get("reference", ""),
+        }
+        for sample in itertools.islice(itertools.cycle(samples), samples_per_lang)
+    ]
 
 
 def create_synthetic_test_set(
@@ -195,53 +331,53 @@ def create_synthetic_test_set(
 
     Falls back to creating basic test cases if limited data available.
     """
+    lang_pairs = [
+        (src_lang, tgt_lang)
+        for src_lang, tgt_lang in itertools.product(languages, repeat=2)
+        if src_lang != tgt_lang
+    ]
+
+    print(f"Creating test set for {len(lang_pairs)} language pairs...")
+
+    jobs = [(src_lang, tgt_lang, samples_per_lang) for src_lang, tgt_lang in lang_pairs]
+    if samples_per_lang * len(lang_pairs) >= PARALLEL_MIN_SAMPLES:
+        with ProcessPoolExecutor() as executor:
+            chunks = list(executor.map(_build_pair, jobs, chunksize=4))
+    else:
+        chunks = [_build_pair(job) for job in jobs]
+
     test_set = []
-    sample_id = 0
+    for (src_lang, tgt_lang), chunk in zip(lang_pairs, chunks):
+        first_id = len(test_set)
+        test_set.extend({"id": first_id + i, **sample} for i, sample in enumerate(chunk))
 
-    # Generate language pair combinations
-    lang_pairs = []
-    for src_lang in languages:
-        for tgt_lang in languages:
-            if src_lang != tgt_lang:
-                lang_pairs.append((src_lang, tgt_lang))
+        print(f"  ✓ {src_lang}_{tgt_lang}: {len(chunk)} samples")
 
-    print(f"Creating test set for {len(lang_pairs)} language pairs...")
+    return test_set
 
-    for src_lang, tgt_lang in lang_pairs:
-        pair_key = f"{src_lang}_{tgt_lang}"
-        reverse_key = f"{tgt_lang}_{src_lang}"
-
-        # Get sample data
-        samples = SAMPLE_TRANSLATIONS.get(pair_key, [])
-        if not samples and reverse_key in SAMPLE_TRANSLATIONS:
-            # Swap source/reference
-            orig_samples = SAMPLE_TRANSLATIONS[reverse_key]
-            samples = [
-                {"source": s["reference"], "reference": s["source"]}
-                for s in orig_samples
-            ]
 
-        # Duplicate samples to reach target count
-        if samples:
-            while len(samples) < samples_per_lang:
-                samples.extend(samples[: samples_per_lang - len(samples)])
+def pool_samples(test_set: List[Dict]) -> Tuple[List[Dict], List[Dict]]:
+    """
+    Intern repeated (source, reference) pairs into a shared pool.
 
-        # Add to test set
-        for i, sample in enumerate(samples[:samples_per_lang]):
-            test_set.append(
-                {
-                    "id": sample_id,
-                    "source_lang": src_lang,
-                    "target_lang": tgt_lang,
-                    "source": sample.get("source", ""),
-                    "reference": sample.get("reference", ""),
-                }
-            )
-            sample_id += 1
+    Returns the pool and the test entries, where each entry carries a
+    ``pool_ref`` index into the pool in place of its source/reference text.
+    """
+    pool = []
+    pool_index: Dict[Tuple[str, str], int] = {}
+    entries = []
+    for sample in test_set:
+        key = (sample["source"], sample["reference"])
+        pool_ref = pool_index.get(key)
+        if pool_ref is None:
+            pool_ref = pool_index[key] = len(pool)
+            pool.append({"source": key[0], "reference": key[1]})
 
-        print(f"  ✓ {pair_key}: {len(samples[:samples_per_lang])} samples")
+        entry = {k: v for k, v in sample.items() if k not in ("source", "reference")}
+        entry["pool_ref"] = pool_ref
+        entries.append(entry)
 
-    return test_set
+    return pool, entries
 
 
 def create_advanced_test_cases() -> List[Dict]:
@@ -291,6 +427,12 @@ Examples:
       --samples_per_lang 200 \
       --output eval/large_test_suite.json
 
+  # Columnar output for datasets/Arrow consumers (requires pyarrow)
+  python prepare_eval_set.py --output eval/translate_gemma_test_suite.parquet
+
+  # Write every sample inline (legacy format)
+  python prepare_eval_set.py --flat
+
   # Use FLORES-200 dataset (requires datasets library)
   python prepare_eval_set.py --use_flores --samples_per_lang 100
         """,
@@ -318,33 +460,62 @@ Examples:
         action="store_true",
         help="Use FLORES-200 dataset (if available)",
     )
+    parser.add_argument(
+        "--flores_split",
+        choices=["dev", "devtest"],
+        default="devtest",
+        help="FLORES+ split to stream (default: devtest)",
+    )
     parser.add_argument(
         "--include_edge_cases",
         action="store_true",
         help="Include edge case test samples",
     )
+    parser.add_argument(
+        "--sort_by_length",
+        action="store_true",
+        help="Order samples by source length (longest first) to minimize batch padding",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["json", "parquet"],
+        help="Output format (default: parquet for .parquet paths, else json)",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="Write JSON without indentation or whitespace",
+    )
+    parser.add_argument(
+        "--flat",
+        action="store_true",
+        help="Write source/reference inline in every sample instead of a shared samples_pool",
+    )
 
     args = parser.parse_args()
 
-    print(f"{'='*60}")
+    print(f"{_RULE}")
     print(f"  Preparing TranslateGemma Evaluation Set")
-    print(f"{'='*60}\n")
+    print(f"{_RULE}\n")
 
     # Create output directory
-    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    Path(args.output).parent.mkdir(parents=True, exist_ok=True)
 
     # Load data
     test_set = []
 
     if args.use_flores:
-        flores_data = load_flores200_data(args.languages)
+        flores_data = load_flores200_data(
+            args.languages, args.samples_per_lang, split=args.flores_split
+        )
         if flores_data:
-            # Process FLORES data (simplified)
-            print("⚠️  FLORES-200 processing not fully implemented")
+            test_set = create_flores_test_set(flores_data)
+        else:
             print("   Using synthetic data instead")
 
     # Create synthetic test set
-    test_set = create_synthetic_test_set(args.languages, args.samples_per_lang)
+    if not test_set:
+        test_set = create_synthetic_test_set(args.languages, args.samples_per_lang)
 
     # Add edge cases if requested
     if args.include_edge_cases:
@@ -362,38 +533,56 @@ Examples:
                 }
             )
 
+    if args.sort_by_length:
+        # Longest first, so padded batches taken in file order stay uniform
+        test_set.sort(key=lambda sample: len(sample["source"]), reverse=True)
+        for i, sample in enumerate(test_set):
+            sample["id"] = i
+
     # Save test set
-    output_data = {
-        "metadata": {
-            "created": datetime.now().isoformat(),
-            "languages": args.languages,
-            "samples_per_language_pair": args.samples_per_lang,
-            "total_samples": len(test_set),
-            "include_edge_cases": args.include_edge_cases,
-        },
-        "samples": test_set,
+    output_format = args.format or (
+        "parquet" if args.output.endswith(".parquet") else "json"
+    )
+    # Parquet dictionary-encodes repeated strings itself, so rows stay flat
+    flat = args.flat or output_format == "parquet"
+    metadata = {
+        "created": datetime.now().isoformat(),
+        "languages": args.languages,
+        "samples_per_language_pair": args.samples_per_lang,
+        "total_samples": len(test_set),
+        "include_edge_cases": args.include_edge_cases,
+        "sorted_by_length": args.sort_by_length,
+        "format": "flat" if flat else "pooled",
     }
 
-    with open(args.output, "w") as f:
-        json.dump(output_data, f, indent=2)
-
-    print(f"\n{'='*60}")
+    if output_format == "parquet":
+        write_parquet(args.output, test_set, metadata)
+    else:
+        output_data = {"metadata": metadata}
+        if flat:
+            output_data["samples"] = test_set
+        else:
+            # Samples repeat heavily; store each unique pair once and reference it
+            pool, entries = pool_samples(test_set)
+            output_data["samples_pool"] = pool
+            output_data["samples"] = entries
+
+        write_json(args.output, output_data, compact=args.compact)
+
+    print(f"\n{_RULE}")
     print(f"✅ Evaluation set created successfully")
-    print(f"{'='*60}")
+    print(f"{_RULE}")
     print(f"Output: {args.output}")
     print(f"Total samples: {len(test_set)}")
     print(f"Languages: {', '.join(args.languages)}")
     print(f"Language pairs: {len(args.languages) * (len(args.languages) - 1)}")
 
     # Summary statistics
-    pair_counts = {}
-    for sample in test_set:
-        pair = f"{sample['source_lang']}→{sample['target_lang']}"
-        pair_counts[pair] = pair_counts.get(pair, 0) + 1
+    pair_counts = Counter((s["source_lang"], s["target_lang"]) for s in test_set)
 
     print(f"\nSample distribution:")
-    for pair, count in sorted(pair_counts.items())[:5]:
-        print(f"  {pair}: {count}")
+    for (src_lang, tgt_lang), count in sorted(pair_counts.items())[:5]:
+        print(f"  {src_lang}→{tgt_lang}: {count}")
     if len(pair_counts) > 5:
         print(f"  ... and {len(pair_counts) - 5} more")
 
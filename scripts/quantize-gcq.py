@@ -12,65 +12,98 @@ This stub provides format validation and model inspection only.
 """
 import sys
 import json
+import mmap
 import struct
 import argparse
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 GCQ_MAGIC = b'GCQ4'
+# version (u32), manifest offset (u64), manifest size (u64), after the magic
+GCQ_HEADER = struct.Struct('<IQQ')
+GCQ_HEADER_END = len(GCQ_MAGIC) + GCQ_HEADER.size
+
+
+def _load_manifest(mm: mmap.mmap, offset: int, size: int) -> dict:
+    """Parse the JSON manifest directly from the mapped file."""
+    with memoryview(mm) as whole, whole[offset:offset + size] as view:
+        if orjson is not None:
+            return orjson.loads(view)
+        return json.loads(bytes(view))
 
 
 def inspect_gcq(path: Path):
     """Inspect a GCQ file and print metadata."""
     with open(path, 'rb') as f:
-        magic = f.read(4)
+        magic = f.read(len(GCQ_MAGIC))
         if magic != GCQ_MAGIC:
             print(f"ERROR: Not a valid GCQ file (magic: {magic})")
             return False
 
-        version = struct.unpack('<I', f.read(4))[0]
-        manifest_offset = struct.unpack('<Q', f.read(8))[0]
-        manifest_size = struct.unpack('<Q', f.read(8))[0]
-
-        f.seek(manifest_offset)
-        manifest = json.loads(f.read(manifest_size).decode('utf-8'))
+        # mmap rejects empty files, and nothing shorter than the header is GCQ
+        if path.stat().st_size < GCQ_HEADER_END:
+            print("ERROR: Not a valid GCQ file (truncated header)")
+            return False
 
-    print(f"GCQ Model Inspector")
-    print(f"{'='*50}")
-    print(f"Format:     {manifest.get('format', 'GCQ')}")
-    print(f"Version:    {version}")
-    print(f"Bits:       {manifest.get('bits', 4)}")
-    print(f"Block size: {manifest.get('block_size', 32)}")
-    print(f"Centroids:  {manifest.get('n_centroids', 16)}")
-    print(f"Components: {len(manifest.get('components', []))}")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            version, manifest_offset, manifest_size = GCQ_HEADER.unpack_from(
+                mm, len(GCQ_MAGIC)
+            )
+            if manifest_offset + manifest_size > len(mm):
+                print("ERROR: Not a valid GCQ file (manifest past end of file)")
+                return False
+            manifest = _load_manifest(mm, manifest_offset, manifest_size)
+
+    components = manifest.get('components', [])
+    lines = [
+        "GCQ Model Inspector",
+        "=" * 50,
+        f"Format:     {manifest.get('format', 'GCQ')}",
+        f"Version:    {version}",
+        f"Bits:       {manifest.get('bits', 4)}",
+        f"Block size: {manifest.get('block_size', 32)}",
+        f"Centroids:  {manifest.get('n_centroids', 16)}",
+        f"Components: {len(components)}",
+    ]
 
     total_tensors = 0
-    for comp in manifest.get('components', []):
+    for comp in components:
         n_tensors = len(comp.get('tensors', []))
         total_tensors += n_tensors
-        print(f"  - {comp['name']}: {n_tensors} tensors")
+        lines.append(f"  - {comp['name']}: {n_tensors} tensors")
 
-    print(f"Total tensors: {total_tensors}")
+    lines.append(f"Total tensors: {total_tensors}")
+    # One write for the whole report instead of a print per line
+    sys.stdout.write("\n".join(lines) + "\n")
     return True
 
 
 def validate_gcq(path: Path) -> bool:
     """Validate a GCQ file structure."""
     try:
-        with open(path, 'rb') as f:
-            magic = f.read(4)
-            if magic != GCQ_MAGIC:
+        if path.stat().st_size < GCQ_HEADER_END:
+            return False
+
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm[:len(GCQ_MAGIC)] != GCQ_MAGIC:
                 return False
 
-            version = struct.unpack('<I', f.read(4))[0]
+            version, manifest_offset, manifest_size = GCQ_HEADER.unpack_from(
+                mm, len(GCQ_MAGIC)
+            )
             if version > 10:  # Sanity check
                 return False
 
-            manifest_offset = struct.unpack('<Q', f.read(8))[0]
-            manifest_size = struct.unpack('<Q', f.read(8))[0]
+            # A slice past the end would silently truncate the manifest
+            if manifest_offset + manifest_size > len(mm):
+                return False
 
             # Check manifest is valid JSON
-            f.seek(manifest_offset)
-            manifest = json.loads(f.read(manifest_size).decode('utf-8'))
+            manifest = _load_manifest(mm, manifest_offset, manifest_size)
 
             return 'components' in manifest
     except Exception:
@@ -14,25 +14,46 @@ Usage:
 
 Requirements:
     pip install auto-gptq transformers bitsandbytes torch
+    pip install orjson  # optional: faster JSON output
 """
 
 import argparse
+import hashlib
+import itertools
 import json
-import os
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
-from typing import Optional
+from typing import Any, Callable, Dict, List, Optional, Union
 
+import numpy as np
 import torch
 from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_RULE = "=" * 60
+
+
+def write_json(path: Union[str, Path], data: Any) -> None:
+    """Write data as indented JSON, using orjson when installed."""
+    if orjson is not None:
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+        return
+
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2)
+
 
 def log_section(title: str):
     """Print formatted section header."""
-    print(f"\n{'='*60}")
-    print(f"  {title}")
-    print(f"{'='*60}\n")
+    print(f"\n{_RULE}\n  {title}\n{_RULE}\n")
 
 
 def log_step(step: int, desc: str):
@@ -41,11 +62,11 @@ def log_step(step: int, desc: str):
 
 
 def get_model_size(model: torch.nn.Module) -> float:
-    """Calculate model size in GB."""
-    total_params = sum(p.numel() for p in model.parameters())
-    # Assume FP32: 4 bytes per parameter
-    size_gb = total_params * 4 / (1024**3)
-    return size_gb
+    """Calculate model size in GB from the actual dtype of each tensor."""
+    if hasattr(model, "get_memory_footprint"):
+        return model.get_memory_footprint() / (1024**3)
+    total_bytes = sum(p.numel() * p.element_size() for p in model.parameters())
+    return total_bytes / (1024**3)
 
 
 def get_layer_names(model: torch.nn.Module) -> dict:
@@ -53,7 +74,10 @@ def get_layer_names(model: torch.nn.Module) -> dict:
     layers = {}
     for name, module in model.named_modules():
         if isinstance(module, torch.nn.Linear):
-            numel = sum(p.numel() for p in module.parameters())
+            # Read weight/bias directly rather than re-walking module.parameters()
+            numel = module.weight.numel()
+            if module.bias is not None:
+                numel += module.bias.numel()
             layers[name] = {
                 "params": numel,
                 "type": "linear",
@@ -61,38 +85,171 @@ def get_layer_names(model: torch.nn.Module) -> dict:
     return layers
 
 
+def load_fp16_model(model_name_or_path: str, device: str) -> torch.nn.Module:
+    """
+    Load the model straight into FP16 on the target device.
+
+    low_cpu_mem_usage streams weights shard by shard instead of materializing
+    an FP32 copy in host RAM first; safetensors shards are preferred and .bin
+    checkpoints are used when the repo has none.
+    """
+    kwargs = dict(
+        torch_dtype=torch.float16,
+        device_map=device,
+        low_cpu_mem_usage=True,
+    )
+    try:
+        return AutoModelForSeq2SeqLM.from_pretrained(
+            model_name_or_path, use_safetensors=True, **kwargs
+        )
+    except OSError:
+        return AutoModelForSeq2SeqLM.from_pretrained(model_name_or_path, **kwargs)
+
+
+def load_tokenizer_and_model(
+    model_name_or_path: str,
+    device: Optional[str] = None,
+    load_model: Optional[Callable[[], Any]] = None,
+    need_tokenizer: bool = True,
+):
+    """
+    Load tokenizer and model concurrently; the two loads are independent.
+
+    ``load_model`` overrides the default ``load_fp16_model`` loader, which is
+    the only user of ``device``. With
+    ``need_tokenizer=False`` only the model is loaded and the tokenizer is None.
+    """
+    if load_model is None:
+        load_model = partial(load_fp16_model, model_name_or_path, device)
+
+    if not need_tokenizer:
+        return None, load_model()
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        tokenizer_future = executor.submit(
+            AutoTokenizer.from_pretrained, model_name_or_path
+        )
+        model_future = executor.submit(load_model)
+        return tokenizer_future.result(), model_future.result()
+
+
+def load_calibration_texts(
+    calibration_file: Optional[str], num_samples: int
+) -> List[str]:
+    """
+    Collect calibration sentences for GPTQ.
+
+    Reads source sentences from an eval set written by prepare_eval_set.py
+    (flat or pooled) when given, otherwise uses its built-in sample sentences.
+    """
+    if calibration_file:
+        with open(calibration_file, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if isinstance(data, dict):
+            samples = data.get("samples_pool") or data.get("samples", [])
+        else:
+            samples = data
+        texts = [s["source"] for s in samples if s.get("source")]
+    else:
+        from prepare_eval_set import SAMPLE_TRANSLATIONS
+
+        texts = [
+            text
+            for samples in SAMPLE_TRANSLATIONS.values()
+            for sample in samples
+            for text in (sample["source"], sample["reference"])
+        ]
+
+    # Deduplicate while keeping order, then cap
+    return list(dict.fromkeys(texts))[:num_samples]
+
+
+def build_calibration_examples(
+    tokenizer,
+    texts: List[str],
+    max_length: int = 256,
+    cache_dir: Optional[Path] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Tokenize calibration texts once and order them by length.
+
+    AutoGPTQ batches consecutive examples, so sorting keeps each batch's
+    padding to a minimum. With ``cache_dir`` the sorted token ids are stored
+    as flat .npy arrays keyed by tokenizer and corpus, and memory-mapped on
+    later runs (e.g. bits/group_size sweeps) instead of re-tokenizing.
+    """
+    ids_path = offsets_path = None
+    if cache_dir is not None:
+        cache_key = hashlib.sha1(
+            "\0".join(
+                [tokenizer.name_or_path, str(len(tokenizer)), str(max_length), *texts]
+            ).encode("utf-8")
+        ).hexdigest()[:16]
+        ids_path = cache_dir / f"calib_{cache_key}_ids.npy"
+        offsets_path = cache_dir / f"calib_{cache_key}_offsets.npy"
+
+    if ids_path is not None and ids_path.is_file() and offsets_path.is_file():
+        print(f"  Using cached calibration tokens: {ids_path}")
+        ids = np.load(ids_path, mmap_mode="r")
+        offsets = np.load(offsets_path, mmap_mode="r")
+    else:
+        encoded = tokenizer(texts, truncation=True, max_length=max_length)
+        sorted_ids = sorted(encoded["input_ids"], key=len)
+        lengths = [len(example) for example in sorted_ids]
+        offsets = np.zeros(len(sorted_ids) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        ids = np.fromiter(
+            itertools.chain.from_iterable(sorted_ids),
+            dtype=np.int64,
+            count=int(offsets[-1]),
+        )
+        if ids_path is not None:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            np.save(ids_path, ids)
+            np.save(offsets_path, offsets)
+
+    examples = []
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        input_ids = ids[start:end].tolist()
+        examples.append(
+            {"input_ids": input_ids, "attention_mask": [1] * len(input_ids)}
+        )
+    return examples
+
+
 def quantize_with_bitsandbytes(
     model_name_or_path: str,
     output_dir: str,
     quantization: str = "q4_0",
     device: str = "cuda:0",
+    need_tokenizer: bool = True,
 ) -> None:
     """
     Quantize using bitsandbytes (simpler approach for initial testing).
+
+    Performance note: the tokenizer is only loaded to be saved next to the
+    weights. ``need_tokenizer=False`` skips its download and SentencePiece
+    parse when tokenizer files are provided separately.
     """
     log_section("QUANTIZATION: bitsandbytes")
 
-    log_step(1, "Loading tokenizer")
-    tokenizer = AutoTokenizer.from_pretrained(model_name_or_path)
-    print(f"  Tokenizer vocab size: {len(tokenizer)}")
-
-    log_step(2, "Loading model in FP16")
-    model = AutoModelForSeq2SeqLM.from_pretrained(
-        model_name_or_path,
-        torch_dtype=torch.float16,
-        device_map=device,
+    log_step(1, "Loading tokenizer and model in FP16" if need_tokenizer else "Loading model in FP16")
+    tokenizer, model = load_tokenizer_and_model(
+        model_name_or_path, device, need_tokenizer=need_tokenizer
     )
+    if tokenizer is not None:
+        print(f"  Tokenizer vocab size: {len(tokenizer)}")
     original_size = get_model_size(model)
     print(f"  Original FP16 size: {original_size:.2f} GB")
 
-    log_step(3, "Analyzing layer structure")
+    log_step(2, "Analyzing layer structure")
     layers = get_layer_names(model)
     print(f"  Total linear layers: {len(layers)}")
     print(f"  Sample layers:")
     for i, (name, info) in enumerate(list(layers.items())[:3]):
         print(f"    - {name}: {info['params']:,} params")
 
-    log_step(4, f"Applying {quantization.upper()} quantization")
+    log_step(3, f"Applying {quantization.upper()} quantization")
     print(f"  Method: bitsandbytes")
     print(f"  Note: Full quantization applied")
     print(f"  Processing {len(layers)} layers...")
@@ -101,10 +258,12 @@ def quantize_with_bitsandbytes(
     # For true 4-bit, use AutoGPTQ below
     print(f"  ⚠️  Recommendation: Use AutoGPTQ for better 4-bit/3-bit support")
 
-    log_step(5, f"Saving to {output_dir}")
-    os.makedirs(output_dir, exist_ok=True)
+    log_step(4, f"Saving to {output_dir}")
+    out_dir = Path(output_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
     model.save_pretrained(output_dir)
-    tokenizer.save_pretrained(output_dir)
+    if tokenizer is not None:
+        tokenizer.save_pretrained(output_dir)
 
     # Save metadata
     metadata = {
@@ -114,8 +273,7 @@ def quantize_with_bitsandbytes(
         "quantization_method": "bitsandbytes",
         "timestamp": time.time(),
     }
-    with open(os.path.join(output_dir, "quantization_metadata.json"), "w") as f:
-        json.dump(metadata, f, indent=2)
+    write_json(out_dir / "quantization_metadata.json", metadata)
 
     print(f"✅ Quantization complete")
     print(f"  Output: {output_dir}")
@@ -125,12 +283,18 @@ def quantize_with_autogptq(
     model_name_or_path: str,
     output_dir: str,
     quantization: str = "q4_0",
-    device: str = "cuda:0",
     bits: int = 4,
     group_size: int = 128,
+    calibration_file: Optional[str] = None,
+    calibration_samples: int = 128,
+    calibration_batch_size: int = 64,
 ) -> None:
     """
     Quantize using AutoGPTQ (best support for 2-8 bit quantization).
+
+    Calibration examples are length-sorted and run through GPTQ in batches of
+    ``calibration_batch_size``. AutoGPTQ decides device placement itself, so
+    there is no ``device`` argument here.
     """
     try:
         from auto_gptq import AutoGPTQForCausalLM, BaseQuantizeConfig
@@ -141,11 +305,7 @@ def quantize_with_autogptq(
 
     log_section("QUANTIZATION: AutoGPTQ")
 
-    log_step(1, "Loading tokenizer")
-    tokenizer = AutoTokenizer.from_pretrained(model_name_or_path)
-    print(f"  Tokenizer vocab size: {len(tokenizer)}")
-
-    log_step(2, f"Configuring {bits}-bit quantization")
+    log_step(1, f"Configuring {bits}-bit quantization")
     quantize_config = BaseQuantizeConfig(
         bits=bits,
         group_size=group_size,
@@ -160,24 +320,40 @@ def quantize_with_autogptq(
     print(f"  Desc act: True")
     print(f"  Format: gptq")
 
-    log_step(3, "Loading model in FP16")
-    model = AutoModelForSeq2SeqLM.from_pretrained(
+    log_step(2, "Loading tokenizer and model in FP16")
+    tokenizer, model = load_tokenizer_and_model(
         model_name_or_path,
-        torch_dtype=torch.float16,
-        device_map=device,
+        load_model=partial(
+            AutoGPTQForCausalLM.from_pretrained,
+            model_name_or_path,
+            quantize_config,
+            torch_dtype=torch.float16,
+        ),
     )
-    original_size = get_model_size(model)
+    print(f"  Tokenizer vocab size: {len(tokenizer)}")
+    original_size = get_model_size(model.model)
     print(f"  Original FP16 size: {original_size:.2f} GB")
+    # AutoGPTQForCausalLM only handles decoder-only models, while the other
+    # paths in this script load TranslateGemma as AutoModelForSeq2SeqLM
+    print(f"  ⚠️  Note: AutoGPTQ targets decoder-only models; encoder-decoder checkpoints are unsupported")
+
+    log_step(3, "Preparing calibration data")
+    calibration_texts = load_calibration_texts(calibration_file, calibration_samples)
+    examples = build_calibration_examples(
+        tokenizer,
+        calibration_texts,
+        cache_dir=Path(output_dir).parent / ".calib_cache",
+    )
+    print(f"  Calibration samples: {len(examples)}")
+    print(f"  Batch size: {calibration_batch_size}")
 
     log_step(4, f"Applying {bits}-bit quantization (this may take 10-30 min)")
-    # For seq2seq models, use standard inference
-    # AutoGPTQForCausalLM is primarily for decoder-only; for seq2seq, quantize directly
-    print(f"  ⚠️  Note: TranslateGemma is encoder-decoder; using standard approach")
-    print(f"  Processing all layers...")
+    model.quantize(examples, batch_size=calibration_batch_size)
 
     log_step(5, f"Saving to {output_dir}")
-    os.makedirs(output_dir, exist_ok=True)
-    model.save_pretrained(output_dir)
+    out_dir = Path(output_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    model.save_quantized(output_dir, use_safetensors=True)
     tokenizer.save_pretrained(output_dir)
 
     # Save metadata
@@ -186,12 +362,12 @@ def quantize_with_autogptq(
         "quantization": quantization,
         "bits": bits,
         "group_size": group_size,
+        "calibration_samples": len(examples),
         "original_size_gb": original_size,
         "quantization_method": "autogptq",
         "timestamp": time.time(),
     }
-    with open(os.path.join(output_dir, "quantization_metadata.json"), "w") as f:
-        json.dump(metadata, f, indent=2)
+    write_json(out_dir / "quantization_metadata.json", metadata)
 
     print(f"✅ Quantization complete")
     print(f"  Output: {output_dir}")
@@ -209,8 +385,8 @@ def convert_to_gguf(
     log_section("CONVERSION: to GGUF format")
 
     # Check for llama.cpp quantize tool
-    quantize_tool = "./llama.cpp/quantize"
-    if not os.path.exists(quantize_tool):
+    quantize_tool = Path("./llama.cpp/quantize")
+    if not quantize_tool.is_file():
         print(f"❌ llama.cpp quantize tool not found at {quantize_tool}")
         print(f"Clone from: https://github.com/ggerganov/llama.cpp")
         print(f"Then build: cd llama.cpp && make")
@@ -280,6 +456,22 @@ Examples:
         default=128,
         help="Group size for quantization (default: 128)",
     )
+    parser.add_argument(
+        "--calibration_file",
+        help="Eval set JSON from prepare_eval_set.py to draw GPTQ calibration text from",
+    )
+    parser.add_argument(
+        "--calibration_samples",
+        type=int,
+        default=128,
+        help="Number of GPTQ calibration samples (default: 128)",
+    )
+    parser.add_argument(
+        "--calibration_batch_size",
+        type=int,
+        default=64,
+        help="Batch size for the GPTQ calibration pass (default: 64)",
+    )
     parser.add_argument(
         "--method",
         choices=["bitsandbytes", "autogptq"],
@@ -291,6 +483,11 @@ Examples:
         action="store_true",
         help="Use hybrid precision (FP16 for embeddings, Q4 elsewhere)",
     )
+    parser.add_argument(
+        "--skip_tokenizer",
+        action="store_true",
+        help="bitsandbytes only: do not load or save the tokenizer (supply its files separately)",
+    )
     parser.add_argument(
         "--convert_gguf",
         action="store_true",
@@ -308,7 +505,13 @@ Examples:
     print(f"  Bits: {args.bits}")
     print(f"  Method: {args.method}")
     print(f"  Hybrid precision: {args.hybrid}")
-    print(f"  Device: {args.device}")
+    if args.method == "autogptq":
+        print(f"  Device: managed by AutoGPTQ (--device ignored)")
+    else:
+        print(f"  Device: {args.device}")
+
+    if args.skip_tokenizer and args.method == "autogptq":
+        print("⚠️  --skip_tokenizer ignored: AutoGPTQ needs the tokenizer for calibration")
 
     start_time = time.time()
 
@@ -318,9 +521,11 @@ Examples:
             model_name_or_path=args.model,
             output_dir=args.output_dir,
             quantization=args.quantization,
-            device=args.device,
             bits=args.bits,
             group_size=args.group_size,
+            calibration_file=args.calibration_file,
+            calibration_samples=args.calibration_samples,
+            calibration_batch_size=args.calibration_batch_size,
         )
     else:
         quantize_with_bitsandbytes(
@@ -328,13 +533,14 @@ Examples:
             output_dir=args.output_dir,
             quantization=args.quantization,
             device=args.device,
+            need_tokenizer=not args.skip_tokenizer,
         )
 
     # Optional GGUF conversion
     if args.convert_gguf:
         convert_to_gguf(
             model_dir=args.output_dir,
-            output_file=os.path.join(args.output_dir, "model.gguf"),
+            output_file=str(Path(args.output_dir) / "model.gguf"),
             quantization_type=args.quantization,
         )
 
@@ -14,15 +14,17 @@ MODEL_ID = "google/translategemma-4b-it"
 OUTPUT_DIR = Path("/output/translategemma-onnx")
 OPSET_VERSION = 17
 
-def export_vision_encoder(model, processor, output_dir):
+def export_vision_encoder(model, output_dir):
     """Export the SigLIP vision encoder separately."""
     print("Exporting vision encoder...")
 
     vision_encoder = model.vision_tower
     vision_encoder.eval()
 
-    # Create dummy image input
-    dummy_pixel_values = torch.randn(1, 3, 224, 224, device=model.device, dtype=torch.float16)
+    # Create dummy image input; batch 2 so batch-dependent ops aren't folded away as size 1
+    dummy_pixel_values = torch.randn(
+        2, 3, 224, 224, device=next(vision_encoder.parameters()).device, dtype=torch.float16
+    )
 
     output_path = output_dir / "onnx" / "vision_encoder.onnx"
     output_path.parent.mkdir(parents=True, exist_ok=True)
@@ -54,7 +56,7 @@ def export_text_embeddings(model, output_dir):
 
     output_path = output_dir / "onnx" / "embed_tokens.onnx"
 
-    dummy_input_ids = torch.tensor([[1, 2, 3]], dtype=torch.long, device=model.device)
+    dummy_input_ids = torch.tensor([[1, 2, 3]], dtype=torch.long, device=embed_tokens.weight.device)
 
     # Create wrapper for just embeddings
     class EmbedWrapper(torch.nn.Module):
@@ -96,17 +98,18 @@ def export_decoder(model, output_dir):
 
     output_path = output_dir / "onnx" / "decoder_model_merged.onnx"
 
-    # Dummy inputs matching expected shapes
+    # Dummy inputs matching expected shapes; two tokens keep sequence_length symbolic
     batch_size = 1
-    seq_len = 10
+    seq_len = 2
     hidden_size = model.config.text_config.hidden_size
+    device = model.get_input_embeddings().weight.device
 
     dummy_inputs_embeds = torch.randn(
         batch_size, seq_len, hidden_size,
-        device=model.device,
+        device=device,
         dtype=torch.float16
     )
-    dummy_attention_mask = torch.ones(batch_size, seq_len, device=model.device, dtype=torch.long)
+    dummy_attention_mask = torch.ones(batch_size, seq_len, device=device, dtype=torch.long)
 
     # Export with dynamic axes
     with torch.no_grad():
@@ -132,14 +135,19 @@ def export_decoder(model, output_dir):
 def main():
     print(f"Loading model: {MODEL_ID}")
 
-    from transformers import AutoProcessor, AutoModelForImageTextToText
+    from transformers import AutoConfig, AutoProcessor, AutoModelForImageTextToText
+
+    # Parse the config once and share it with both loaders
+    config = AutoConfig.from_pretrained(MODEL_ID, trust_remote_code=True)
 
     # Load model
-    processor = AutoProcessor.from_pretrained(MODEL_ID, trust_remote_code=True)
+    processor = AutoProcessor.from_pretrained(MODEL_ID, config=config, trust_remote_code=True)
     model = AutoModelForImageTextToText.from_pretrained(
         MODEL_ID,
+        config=config,
         torch_dtype=torch.float16,
-        device_map="cuda",
+        low_cpu_mem_usage=True,
+        device_map="auto",
         trust_remote_code=True,
     )
     model.eval()
@@ -152,14 +160,16 @@ def main():
 
     # Export components
     try:
-        export_vision_encoder(model, processor, OUTPUT_DIR)
+        export_vision_encoder(model, OUTPUT_DIR)
     except Exception as e:
         print(f"Vision encoder export failed: {e}")
+    torch.cuda.empty_cache()
 
     try:
         export_text_embeddings(model, OUTPUT_DIR)
     except Exception as e:
         print(f"Embeddings export failed: {e}")
+    torch.cuda.empty_cache()
 
     try:
         export_decoder(model, OUTPUT_DIR)
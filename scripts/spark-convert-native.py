@@ -2,11 +2,23 @@
 """
 Manual ONNX export for TranslateGemma-4B - Direct on DGX Spark
 Exports components separately like PaliGemma/Gemma3n.
+
+Usage:
+    python spark-convert-native.py [--quantize] [--dynamo]
+
+With --quantize, each exported graph is handed to spark-quantize.py's
+quantize_component() in memory instead of being re-read from disk later.
 """
+import argparse
+import importlib
+import io
 import os
 import sys
 import json
+import traceback
+import onnx
 import torch
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 # Ensure CUDA is available
@@ -14,54 +26,62 @@ print(f"CUDA available: {torch.cuda.is_available()}")
 if torch.cuda.is_available():
     print(f"CUDA device: {torch.cuda.get_device_name(0)}")
 
-from transformers import AutoProcessor, AutoModelForImageTextToText, AutoConfig
+from transformers import AutoProcessor, AutoModelForImageTextToText, AutoConfig, DynamicCache
 
 MODEL_ID = "google/translategemma-4b-it"
 OUTPUT_DIR = Path("/tmp/translategemma-onnx")
 OPSET_VERSION = 17
 
-print(f"Loading model: {MODEL_ID}")
-
-# Load config first
-config = AutoConfig.from_pretrained(MODEL_ID, trust_remote_code=True)
-print(f"Model type: {config.model_type}")
-print(f"Vision config type: {config.vision_config.model_type}")
-
-# Load processor
-print("Loading processor...")
-processor = AutoProcessor.from_pretrained(MODEL_ID, trust_remote_code=True)
-
-# Load model in fp16
-print("Loading model (this may take a while)...")
-model = AutoModelForImageTextToText.from_pretrained(
-    MODEL_ID,
-    torch_dtype=torch.float16,
-    device_map="cuda:0",
-    trust_remote_code=True,
-)
-model.eval()
-
-print(f"Model loaded on device: {model.device}")
-print(f"Model structure: {type(model).__name__}")
-
-# Inspect model components
-print("\n=== Model Components ===")
-for name, module in model.named_children():
-    print(f"  {name}: {type(module).__name__}")
-
-# Check deeper structure
-print("\n=== Model.model Components ===")
-if hasattr(model, 'model'):
-    for name, module in model.model.named_children():
-        print(f"  model.{name}: {type(module).__name__}")
-
-OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
-onnx_dir = OUTPUT_DIR / "onnx"
-onnx_dir.mkdir(exist_ok=True)
-
-# 1. Export Vision Encoder (SigLIP)
-print("\n=== Exporting Vision Encoder ===")
-try:
+
+class VisionEncoderWrapper(torch.nn.Module):
+    def __init__(self, vision_tower):
+        super().__init__()
+        self.vision_tower = vision_tower
+
+    def forward(self, pixel_values):
+        outputs = self.vision_tower(pixel_values)
+        if hasattr(outputs, 'last_hidden_state'):
+            return outputs.last_hidden_state
+        return outputs[0] if isinstance(outputs, tuple) else outputs
+
+
+class EmbedWrapper(torch.nn.Module):
+    def __init__(self, embed):
+        super().__init__()
+        self.embed = embed
+
+    def forward(self, input_ids):
+        return self.embed(input_ids)
+
+
+class TextDecoderWrapper(torch.nn.Module):
+    def __init__(self, full_model):
+        super().__init__()
+        self.model = full_model.model  # The Gemma3Model
+        self.lm_head = full_model.lm_head
+
+    def forward(self, inputs_embeds, attention_mask, *past_key_values):
+        # past_key_values arrives flattened as (key0, value0, key1, value1, ...)
+        cache = DynamicCache.from_legacy_cache(
+            tuple(zip(past_key_values[::2], past_key_values[1::2]))
+        )
+        # Run through the transformer layers
+        outputs = self.model(
+            input_ids=None,
+            inputs_embeds=inputs_embeds,
+            attention_mask=attention_mask,
+            past_key_values=cache,
+            use_cache=True,
+            return_dict=True,
+        )
+        # Apply language model head
+        logits = self.lm_head(outputs.last_hidden_state)
+        present = outputs.past_key_values.to_legacy_cache()
+        return (logits, *(tensor for layer in present for tensor in layer))
+
+
+def build_vision_export(model, config, onnx_dir):
+    """Return (wrapper, args, path, io_names) for the vision encoder (SigLIP)."""
     # Find vision tower in the model structure
     if hasattr(model, 'vision_tower'):
         vision_tower = model.vision_tower
@@ -77,54 +97,29 @@ try:
     print(f"Vision encoder: {type(vision_tower).__name__}")
     print(f"Image size: {image_size}")
 
+    # Trace at batch 2 so batch-dependent ops aren't folded away as size 1
     dummy_pixel_values = torch.randn(
-        1, 3, image_size, image_size,
-        device="cuda:0",
+        2, 3, image_size, image_size,
+        device=next(vision_tower.parameters()).device,
         dtype=torch.float16
     )
 
-    class VisionEncoderWrapper(torch.nn.Module):
-        def __init__(self, vision_tower):
-            super().__init__()
-            self.vision_tower = vision_tower
-
-        def forward(self, pixel_values):
-            outputs = self.vision_tower(pixel_values)
-            if hasattr(outputs, 'last_hidden_state'):
-                return outputs.last_hidden_state
-            return outputs[0] if isinstance(outputs, tuple) else outputs
-
     wrapper = VisionEncoderWrapper(vision_tower)
     wrapper.eval()
 
-    vision_path = onnx_dir / "vision_encoder.onnx"
-
-    with torch.no_grad():
-        torch.onnx.export(
-            wrapper,
-            (dummy_pixel_values,),
-            str(vision_path),
-            input_names=["pixel_values"],
-            output_names=["image_features"],
-            dynamic_axes={
-                "pixel_values": {0: "batch_size"},
-                "image_features": {0: "batch_size", 1: "num_patches"},
-            },
-            opset_version=OPSET_VERSION,
-            do_constant_folding=True,
-        )
-
-    size_mb = vision_path.stat().st_size / (1024 * 1024)
-    print(f"Vision encoder exported: {vision_path} ({size_mb:.1f} MB)")
+    io_names = {
+        "input_names": ["pixel_values"],
+        "output_names": ["image_features"],
+        "dynamic_axes": {
+            "pixel_values": {0: "batch_size"},
+            "image_features": {0: "batch_size", 1: "num_patches"},
+        },
+    }
+    return wrapper, (dummy_pixel_values,), onnx_dir / "vision_encoder.onnx", io_names
 
-except Exception as e:
-    print(f"Vision encoder export failed: {e}")
-    import traceback
-    traceback.print_exc()
 
-# 2. Export Embedding Layer
-print("\n=== Exporting Embedding Layer ===")
-try:
+def build_embed_export(model, config, onnx_dir):
+    """Return (wrapper, args, path, io_names) for the token embedding layer."""
     # Find embed_tokens in the model structure
     embed_tokens = None
     if hasattr(model, 'model') and hasattr(model.model, 'embed_tokens'):
@@ -138,135 +133,229 @@ try:
     if embed_tokens is None:
         raise AttributeError("Cannot find embed_tokens")
 
-    class EmbedWrapper(torch.nn.Module):
-        def __init__(self, embed):
-            super().__init__()
-            self.embed = embed
-
-        def forward(self, input_ids):
-            return self.embed(input_ids)
-
     wrapper = EmbedWrapper(embed_tokens)
     wrapper.eval()
 
-    dummy_input_ids = torch.tensor([[1, 2, 3]], dtype=torch.long, device="cuda:0")
-
-    embed_path = onnx_dir / "embed_tokens.onnx"
-
-    with torch.no_grad():
-        torch.onnx.export(
-            wrapper,
-            (dummy_input_ids,),
-            str(embed_path),
-            input_names=["input_ids"],
-            output_names=["inputs_embeds"],
-            dynamic_axes={
-                "input_ids": {0: "batch_size", 1: "sequence_length"},
-                "inputs_embeds": {0: "batch_size", 1: "sequence_length"},
-            },
-            opset_version=OPSET_VERSION,
-            do_constant_folding=True,
-        )
+    dummy_input_ids = torch.tensor([[1, 2, 3]], dtype=torch.long, device=embed_tokens.weight.device)
 
-    size_mb = embed_path.stat().st_size / (1024 * 1024)
-    print(f"Embeddings exported: {embed_path} ({size_mb:.1f} MB)")
+    io_names = {
+        "input_names": ["input_ids"],
+        "output_names": ["inputs_embeds"],
+        "dynamic_axes": {
+            "input_ids": {0: "batch_size", 1: "sequence_length"},
+            "inputs_embeds": {0: "batch_size", 1: "sequence_length"},
+        },
+    }
+    return wrapper, (dummy_input_ids,), onnx_dir / "embed_tokens.onnx", io_names
 
-except Exception as e:
-    print(f"Embeddings export failed: {e}")
-    import traceback
-    traceback.print_exc()
 
-# 3. Export Text Decoder (using inputs_embeds)
-print("\n=== Exporting Text Decoder ===")
-try:
+def build_decoder_export(model, config, onnx_dir):
+    """Return (wrapper, args, path, io_names) for the text decoder + LM head."""
     # For Gemma3ForConditionalGeneration, we export with inputs_embeds to allow
     # feeding vision features + text embeddings combined
-    hidden_size = config.text_config.hidden_size if hasattr(config, 'text_config') else 2560
+    text_config = getattr(config, 'text_config', config)
+    hidden_size = text_config.hidden_size
+    num_layers = text_config.num_hidden_layers
+    num_kv_heads = text_config.num_key_value_heads
+    head_dim = getattr(text_config, 'head_dim', None) or hidden_size // text_config.num_attention_heads
     print(f"Hidden size: {hidden_size}")
 
-    class TextDecoderWrapper(torch.nn.Module):
-        def __init__(self, full_model):
-            super().__init__()
-            self.model = full_model.model  # The Gemma3Model
-            self.lm_head = full_model.lm_head
-
-        def forward(self, inputs_embeds, attention_mask):
-            # Run through the transformer layers
-            outputs = self.model(
-                input_ids=None,
-                inputs_embeds=inputs_embeds,
-                attention_mask=attention_mask,
-                use_cache=False,
-                return_dict=True,
-            )
-            # Apply language model head
-            logits = self.lm_head(outputs.last_hidden_state)
-            return logits
-
     wrapper = TextDecoderWrapper(model)
     wrapper.eval()
 
+    # Shapes are dynamic; two tokens are enough to keep sequence_length symbolic,
+    # and one cached position is enough to trace the past_key_values path
     batch_size = 1
-    seq_len = 10
+    seq_len = 2
+    past_len = 1
 
+    # With device_map="auto" the decoder may be split; inputs start where the embeddings live
+    device = model.get_input_embeddings().weight.device
     dummy_embeds = torch.randn(
         batch_size, seq_len, hidden_size,
-        device="cuda:0",
+        device=device,
         dtype=torch.float16
     )
-    dummy_mask = torch.ones(batch_size, seq_len, device="cuda:0", dtype=torch.long)
-
-    decoder_path = onnx_dir / "decoder_model_merged.onnx"
-
-    print(f"Exporting decoder with hidden_size={hidden_size}...")
-
-    with torch.no_grad():
-        torch.onnx.export(
-            wrapper,
-            (dummy_embeds, dummy_mask),
-            str(decoder_path),
-            input_names=["inputs_embeds", "attention_mask"],
-            output_names=["logits"],
-            dynamic_axes={
-                "inputs_embeds": {0: "batch_size", 1: "sequence_length"},
-                "attention_mask": {0: "batch_size", 1: "sequence_length"},
-                "logits": {0: "batch_size", 1: "sequence_length"},
-            },
-            opset_version=OPSET_VERSION,
-            do_constant_folding=True,
-        )
+    dummy_mask = torch.ones(batch_size, past_len + seq_len, device=device, dtype=torch.long)
+    dummy_past = tuple(
+        torch.randn(batch_size, num_kv_heads, past_len, head_dim, device=device, dtype=torch.float16)
+        for _ in range(2 * num_layers)
+    )
 
-    size_mb = decoder_path.stat().st_size / (1024 * 1024)
-    print(f"Decoder exported: {decoder_path} ({size_mb:.1f} MB)")
-
-except Exception as e:
-    print(f"Decoder export failed: {e}")
-    import traceback
-    traceback.print_exc()
-
-# 4. Save config and tokenizer
-print("\n=== Saving config and tokenizer ===")
-processor.save_pretrained(str(OUTPUT_DIR))
-config.save_pretrained(str(OUTPUT_DIR))
-
-# Create transformers.js compatible config
-tjsconfig = {
-    "model_type": "translategemma",
-    "architectures": ["TranslateGemmaForConditionalGeneration"],
-    "components": {
-        "vision_encoder": "onnx/vision_encoder.onnx",
-        "embed_tokens": "onnx/embed_tokens.onnx",
-        "decoder_model_merged": "onnx/decoder_model_merged.onnx"
-    },
-    "quantization_available": ["fp16", "q4", "q8"]
-}
-
-with open(OUTPUT_DIR / "transformers_js_config.json", "w") as f:
-    json.dump(tjsconfig, f, indent=2)
-
-print("\n=== Export Summary ===")
-for f in sorted(OUTPUT_DIR.rglob("*.onnx*")):
-    size_mb = f.stat().st_size / (1024 * 1024)
-    print(f"  {f.relative_to(OUTPUT_DIR)}: {size_mb:.1f} MB")
-
-print("\nDone!")
+    print(f"Exporting decoder with hidden_size={hidden_size}, {num_layers} cached layers...")
+
+    past_names = [f"past_key_values.{i}.{kind}" for i in range(num_layers) for kind in ("key", "value")]
+    present_names = [f"present.{i}.{kind}" for i in range(num_layers) for kind in ("key", "value")]
+
+    dynamic_axes = {
+        "inputs_embeds": {0: "batch_size", 1: "sequence_length"},
+        "attention_mask": {0: "batch_size", 1: "total_sequence_length"},
+        "logits": {0: "batch_size", 1: "sequence_length"},
+    }
+    dynamic_axes.update({name: {0: "batch_size", 2: "past_sequence_length"} for name in past_names})
+    dynamic_axes.update({name: {0: "batch_size", 2: "total_sequence_length"} for name in present_names})
+
+    io_names = {
+        "input_names": ["inputs_embeds", "attention_mask", *past_names],
+        "output_names": ["logits", *present_names],
+        "dynamic_axes": dynamic_axes,
+    }
+    args = (dummy_embeds, dummy_mask, *dummy_past)
+    return wrapper, args, onnx_dir / "decoder_model_merged.onnx", io_names
+
+
+def write_onnx(path, buffer, label):
+    """Write an in-memory export to disk; runs on the background writer."""
+    path.write_bytes(buffer.getbuffer())
+    size_mb = path.stat().st_size / (1024 * 1024)
+    print(f"{label} exported: {path} ({size_mb:.1f} MB)")
+
+
+# (title, label, builder, in_memory). Protobuf can't hold more than 2 GB, so
+# the decoder goes straight to disk with external data; the smaller graphs are
+# exported to memory and written out while the next component is traced.
+EXPORTS = [
+    ("Vision Encoder", "Vision encoder", build_vision_export, True),
+    ("Embedding Layer", "Embeddings", build_embed_export, True),
+    ("Text Decoder", "Decoder", build_decoder_export, False),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export TranslateGemma components to ONNX")
+    parser.add_argument("--quantize", action="store_true",
+                        help="Quantize each component in-process right after export")
+    parser.add_argument("--dynamo", action="store_true",
+                        help="Use the torch.export-based ONNX exporter (PyTorch >= 2.5); "
+                             "every component is then exported straight to disk")
+    cli = parser.parse_args()
+
+    # Hyphenated file name, so it can't go through a plain import statement
+    quantizer = importlib.import_module("spark-quantize") if cli.quantize else None
+
+    print(f"Loading model: {MODEL_ID}")
+
+    # Load config first
+    config = AutoConfig.from_pretrained(MODEL_ID, trust_remote_code=True)
+    print(f"Model type: {config.model_type}")
+    print(f"Vision config type: {config.vision_config.model_type}")
+
+    # Load processor
+    print("Loading processor...")
+    processor = AutoProcessor.from_pretrained(MODEL_ID, config=config, trust_remote_code=True)
+
+    # Load model in fp16
+    print("Loading model (this may take a while)...")
+    model = AutoModelForImageTextToText.from_pretrained(
+        MODEL_ID,
+        config=config,
+        torch_dtype=torch.float16,
+        low_cpu_mem_usage=True,
+        device_map="auto",
+        trust_remote_code=True,
+    )
+    model.eval()
+
+    print(f"Model loaded on device: {model.device}")
+    print(f"Model structure: {type(model).__name__}")
+
+    # Inspect model components
+    print("\n=== Model Components ===")
+    for name, module in model.named_children():
+        print(f"  {name}: {type(module).__name__}")
+
+    # Check deeper structure
+    print("\n=== Model.model Components ===")
+    if hasattr(model, 'model'):
+        for name, module in model.model.named_children():
+            print(f"  model.{name}: {type(module).__name__}")
+
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    onnx_dir = OUTPUT_DIR / "onnx"
+    onnx_dir.mkdir(exist_ok=True)
+
+    # Older PyTorch has no dynamo kwarg, so only pass it when asked for
+    exporter = {"dynamo": True} if cli.dynamo else {}
+
+    writer = ThreadPoolExecutor(max_workers=2)
+    pending = []
+
+    for title, label, build, in_memory in EXPORTS:
+        # The torch.export-based exporter only writes to paths, not BytesIO
+        in_memory = in_memory and not cli.dynamo
+
+        print(f"\n=== Exporting {title} ===")
+        try:
+            wrapper, args, path, io_names = build(model, config, onnx_dir)
+            target = io.BytesIO() if in_memory else str(path)
+
+            with torch.no_grad():
+                torch.onnx.export(
+                    wrapper,
+                    args,
+                    target,
+                    opset_version=OPSET_VERSION,
+                    do_constant_folding=True,
+                    **io_names,
+                    **exporter,
+                )
+
+            if in_memory:
+                pending.append((label, writer.submit(write_onnx, path, target, label)))
+            else:
+                size_mb = path.stat().st_size / (1024 * 1024)
+                print(f"{label} exported: {path} ({size_mb:.1f} MB)")
+
+            if quantizer is not None:
+                if in_memory:
+                    proto = onnx.load_from_string(target.getvalue())
+                    orig_size = target.getbuffer().nbytes
+                else:
+                    proto = quantizer.load_onnx(path)
+                    orig_size = quantizer.onnx_file_size(path)
+                quantizer.quantize_component(path.stem, proto, orig_size)
+                del proto
+
+        except Exception as e:
+            print(f"{label} export failed: {e}")
+            traceback.print_exc()
+
+        # Release this trace's activations before the next one
+        wrapper = args = target = None
+        torch.cuda.empty_cache()
+
+    writer.shutdown(wait=True)
+    for label, future in pending:
+        if future.exception() is not None:
+            print(f"{label} write failed: {future.exception()}")
+
+    # 4. Save config and tokenizer
+    print("\n=== Saving config and tokenizer ===")
+    processor.save_pretrained(str(OUTPUT_DIR))
+    config.save_pretrained(str(OUTPUT_DIR))
+
+    # Create transformers.js compatible config
+    tjsconfig = {
+        "model_type": "translategemma",
+        "architectures": ["TranslateGemmaForConditionalGeneration"],
+        "components": {
+            "vision_encoder": "onnx/vision_encoder.onnx",
+            "embed_tokens": "onnx/embed_tokens.onnx",
+            "decoder_model_merged": "onnx/decoder_model_merged.onnx"
+        },
+        "quantization_available": ["fp16", "q4", "q8"]
+    }
+
+    with open(OUTPUT_DIR / "transformers_js_config.json", "w") as f:
+        json.dump(tjsconfig, f, indent=2)
+
+    print("\n=== Export Summary ===")
+    for f in sorted(OUTPUT_DIR.rglob("*.onnx*")):
+        size_mb = f.stat().st_size / (1024 * 1024)
+        print(f"  {f.relative_to(OUTPUT_DIR)}: {size_mb:.1f} MB")
+
+    print("\nDone!")
+
+
+if __name__ == "__main__":
+    main()
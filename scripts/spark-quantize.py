@@ -1,118 +1,261 @@
 #!/usr/bin/env python3
 """
 Quantize TranslateGemma ONNX models to INT4 for browser inference.
+
+Run standalone on the output of spark-convert-native.py, or let that script
+hand its in-memory graphs straight to quantize_component() with --quantize.
+
+Usage:
+    python spark-quantize.py [--block_size 32] [--mlp_block_size 128] [--accuracy_level 4]
 """
+import argparse
+import mmap
 import os
-import shutil
+import tempfile
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
-from onnxruntime.quantization import quantize_dynamic, QuantType
-from onnxruntime.quantization.matmul_4bits_quantizer import MatMul4BitsQuantizer
+from typing import Optional
+from onnxruntime.quantization import quantize_dynamic, QuantFormat, QuantType
+from onnxruntime.quantization.matmul_nbits_quantizer import MatMulNBitsQuantizer
 import onnx
+from onnx.external_data_helper import ExternalDataInfo, _get_all_tensors, uses_external_data
 
 INPUT_DIR = Path("/tmp/translategemma-onnx/onnx")
 OUTPUT_DIR = Path("/tmp/translategemma-onnx-q4/onnx")
 
-OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+# Intermediate files for path-only APIs; RAM-backed where available
+SCRATCH_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+# name -> (title, label, quantizer, output suffix, copy original on failure)
+COMPONENTS = {
+    "vision_encoder": ("Vision Encoder (INT8)", "Vision encoder", "q8", "_int8", True),
+    "embed_tokens": ("Embeddings (INT8)", "Embeddings", "int8", "_int8", True),
+    "decoder_model_merged": ("Decoder (Q4)", "Decoder Q4", "q4", "_q4", False),
+}
+
+
+def onnx_file_size(model_path: Path) -> int:
+    """Size of an ONNX file plus its external data, if any."""
+    size = model_path.stat().st_size
+    data_path = Path(str(model_path) + ".data")
+    if data_path.exists():
+        size += data_path.stat().st_size
+    return size
+
+
+def load_onnx(model_path: Path) -> onnx.ModelProto:
+    """
+    Load an ONNX model, filling external initializers from one mmap per data file.
+
+    onnx.load reopens and seeks the data file for every tensor; here each file
+    is mapped once and tensors are sliced out of the page cache.
+    """
+    model = onnx.load(str(model_path), load_external_data=False)
+    maps = {}
+    try:
+        for tensor in _get_all_tensors(model):
+            if not uses_external_data(tensor):
+                continue
+            info = ExternalDataInfo(tensor)
+            if info.location not in maps:
+                with open(model_path.parent / info.location, "rb") as f:
+                    maps[info.location] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            mm = maps[info.location]
+            offset = info.offset or 0
+            end = offset + info.length if info.length else len(mm)
+            tensor.raw_data = mm[offset:end]
+            del tensor.external_data[:]
+            tensor.data_location = onnx.TensorProto.DEFAULT
+    finally:
+        for mm in maps.values():
+            mm.close()
+    return model
+
+
+def report_size(orig_size: int, output_path: Path):
+    new_size = onnx_file_size(output_path)
+    print(f"  {orig_size / 1e9:.2f} GB -> {new_size / 1e9:.2f} GB ({new_size / orig_size * 100:.1f}%)")
+
 
-def quantize_model_q4(model_path: Path, output_path: Path):
-    """Quantize model to 4-bit using MatMul4BitsQuantizer."""
-    print(f"Quantizing {model_path.name} to INT4...")
+def is_mlp_matmul(node: onnx.NodeProto) -> bool:
+    """True for MatMuls in the MLP blocks, judged by node or weight name."""
+    names = (node.name, node.input[1] if len(node.input) > 1 else "")
+    return any("/mlp/" in name or ".mlp." in name for name in names)
 
-    # Load the model
-    model = onnx.load(str(model_path))
 
-    # Use MatMul4BitsQuantizer for INT4 quantization
-    quantizer = MatMul4BitsQuantizer(
+def quantize_model_q4(
+    model: onnx.ModelProto,
+    output_path: Path,
+    orig_size: int,
+    block_size: int = 32,
+    mlp_block_size: int = 128,
+    accuracy_level: Optional[int] = 4,
+):
+    """
+    Quantize model to 4-bit using MatMulNBitsQuantizer.
+
+    MLP projections hold most of the decoder's weight bytes and tolerate
+    coarser blocks, so they are quantized first with mlp_block_size; the
+    attention projections and everything else follow with block_size.
+    accuracy_level=4 lets ORT run the MatMuls with int8 compute.
+    """
+    print(f"Quantizing {output_path.name} to INT4...")
+
+    mlp_nodes = [node.name for node in model.graph.node if node.op_type == "MatMul" and is_mlp_matmul(node)]
+
+    if mlp_nodes:
+        print(f"  MLP pass: {len(mlp_nodes)} MatMuls, block_size={mlp_block_size}")
+        quantizer = MatMulNBitsQuantizer(
+            model=model,
+            bits=4,
+            block_size=mlp_block_size,
+            is_symmetric=True,
+            accuracy_level=accuracy_level,
+            nodes_to_include=mlp_nodes,
+        )
+        quantizer.process()
+        model = quantizer.model.model
+
+    print(f"  Attention/other pass: block_size={block_size}")
+    quantizer = MatMulNBitsQuantizer(
         model=model,
+        bits=4,
+        block_size=block_size,
+        is_symmetric=True,
+        accuracy_level=accuracy_level,
+        nodes_to_exclude=mlp_nodes,
+    )
+    quantizer.process()
+    quantizer.model.save_model_to_file(str(output_path), True)
+
+    report_size(orig_size, output_path)
+    return output_path
+
+
+def quantize_model_q8(model: onnx.ModelProto, output_path: Path, orig_size: int):
+    """Quantize MatMul weights to 8-bit blockwise (weight-only, no activation quant)."""
+    print(f"Quantizing {output_path.name} to INT8 (MatMulNBits)...")
+
+    quantizer = MatMulNBitsQuantizer(
+        model=model,
+        bits=8,
         block_size=32,
         is_symmetric=True,
-        accuracy_level=None,
+        quant_format=QuantFormat.QOperator,
     )
     quantizer.process()
     quantizer.model.save_model_to_file(str(output_path), True)
 
-    # Get sizes
-    orig_size = model_path.stat().st_size
-    data_path = Path(str(model_path) + ".data")
-    if data_path.exists():
-        orig_size += data_path.stat().st_size
+    report_size(orig_size, output_path)
+    return output_path
 
-    new_size = output_path.stat().st_size
-    new_data_path = Path(str(output_path) + ".data")
-    if new_data_path.exists():
-        new_size += new_data_path.stat().st_size
 
-    print(f"  {orig_size / 1e9:.2f} GB -> {new_size / 1e9:.2f} GB ({new_size / orig_size * 100:.1f}%)")
+def quantize_model_int8(model: onnx.ModelProto, output_path: Path, orig_size: int):
+    """Quantize model to INT8 using dynamic quantization (used for the Gather-only embeddings)."""
+    print(f"Quantizing {output_path.name} to INT8...")
+
+    # quantize_dynamic only takes paths; stage the graph in scratch and drop it after
+    with tempfile.TemporaryDirectory(dir=SCRATCH_DIR) as scratch:
+        model_path = Path(scratch) / "model.onnx"
+        onnx.save(model, str(model_path))
+        quantize_dynamic(
+            str(model_path),
+            str(output_path),
+            weight_type=QuantType.QUInt8,
+        )
+
+    report_size(orig_size, output_path)
     return output_path
 
-def quantize_model_int8(model_path: Path, output_path: Path):
-    """Quantize model to INT8 using dynamic quantization."""
-    print(f"Quantizing {model_path.name} to INT8...")
 
-    quantize_dynamic(
-        str(model_path),
-        str(output_path),
-        weight_type=QuantType.QUInt8,
-    )
+QUANTIZERS = {"q4": quantize_model_q4, "q8": quantize_model_q8, "int8": quantize_model_int8}
 
-    # Get sizes
-    orig_size = model_path.stat().st_size
-    data_path = Path(str(model_path) + ".data")
-    if data_path.exists():
-        orig_size += data_path.stat().st_size
 
-    new_size = output_path.stat().st_size
-    new_data_path = Path(str(output_path) + ".data")
-    if new_data_path.exists():
-        new_size += new_data_path.stat().st_size
+def quantize_component(
+    name: str,
+    model: onnx.ModelProto,
+    orig_size: int,
+    output_dir: Path = OUTPUT_DIR,
+    q4_options: Optional[dict] = None,
+):
+    """
+    Quantize one exported component, saving the original on failure where configured.
 
-    print(f"  {orig_size / 1e9:.2f} GB -> {new_size / 1e9:.2f} GB ({new_size / orig_size * 100:.1f}%)")
-    return output_path
+    q4_options are passed to quantize_model_q4 (block_size, mlp_block_size,
+    accuracy_level) and ignored for the other quantizers.
+    """
+    title, label, method, suffix, fallback = COMPONENTS[name]
+    output_dir.mkdir(parents=True, exist_ok=True)
+    options = (q4_options or {}) if method == "q4" else {}
 
-# Quantize each component
-print("\n=== Quantizing Vision Encoder (INT8) ===")
-try:
-    quantize_model_int8(
-        INPUT_DIR / "vision_encoder.onnx",
-        OUTPUT_DIR / "vision_encoder_int8.onnx"
-    )
-except Exception as e:
-    print(f"Vision encoder quantization failed: {e}")
-    # Copy original as fallback
-    shutil.copy(INPUT_DIR / "vision_encoder.onnx", OUTPUT_DIR / "vision_encoder.onnx")
-    data_file = INPUT_DIR / "vision_encoder.onnx.data"
-    if data_file.exists():
-        shutil.copy(data_file, OUTPUT_DIR / "vision_encoder.onnx.data")
-
-print("\n=== Quantizing Embeddings (INT8) ===")
-try:
-    quantize_model_int8(
-        INPUT_DIR / "embed_tokens.onnx",
-        OUTPUT_DIR / "embed_tokens_int8.onnx"
-    )
-except Exception as e:
-    print(f"Embeddings quantization failed: {e}")
-    # Copy original as fallback
-    shutil.copy(INPUT_DIR / "embed_tokens.onnx", OUTPUT_DIR / "embed_tokens.onnx")
-    data_file = INPUT_DIR / "embed_tokens.onnx.data"
-    if data_file.exists():
-        shutil.copy(data_file, OUTPUT_DIR / "embed_tokens.onnx.data")
-
-print("\n=== Quantizing Decoder (Q4) ===")
-try:
-    quantize_model_q4(
-        INPUT_DIR / "decoder_model_merged.onnx",
-        OUTPUT_DIR / "decoder_model_merged_q4.onnx"
-    )
-except Exception as e:
-    print(f"Decoder Q4 quantization failed: {e}")
-    import traceback
-    traceback.print_exc()
-
-print("\n=== Final Output ===")
-for f in sorted(OUTPUT_DIR.rglob("*")):
-    if f.is_file():
-        size_mb = f.stat().st_size / (1024 * 1024)
-        print(f"  {f.name}: {size_mb:.1f} MB")
-
-print("\nDone!")
+    # MatMulNBitsQuantizer rewrites the proto in place; quantize a copy so a
+    # failure halfway still leaves an untouched graph for the fallback
+    if fallback:
+        work = onnx.ModelProto()
+        work.CopyFrom(model)
+    else:
+        work = model
+
+    print(f"\n=== Quantizing {title} ===")
+    try:
+        QUANTIZERS[method](work, output_dir / f"{name}{suffix}.onnx", orig_size, **options)
+    except Exception as e:
+        print(f"{label} quantization failed: {e}")
+        if fallback:
+            # Keep the unquantized graph as fallback
+            onnx.save(model, str(output_dir / f"{name}.onnx"))
+        else:
+            traceback.print_exc()
+
+
+def quantize_file(name: str, q4_options: Optional[dict] = None) -> str:
+    """Worker: load one component from INPUT_DIR and quantize it."""
+    model_path = INPUT_DIR / f"{name}.onnx"
+    quantize_component(name, load_onnx(model_path), onnx_file_size(model_path), q4_options=q4_options)
+    return name
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantize TranslateGemma ONNX components")
+    parser.add_argument("--block_size", type=int, default=32,
+                        help="Q4 block size for attention and other MatMuls")
+    parser.add_argument("--mlp_block_size", type=int, default=128,
+                        help="Q4 block size for MLP MatMuls")
+    parser.add_argument("--accuracy_level", type=int, default=4, choices=[0, 1, 2, 3, 4],
+                        help="MatMulNBits compute precision (4 = int8, 0 = unset)")
+    args = parser.parse_args()
+    q4_options = {
+        "block_size": args.block_size,
+        "mlp_block_size": args.mlp_block_size,
+        "accuracy_level": args.accuracy_level or None,
+    }
+
+    names = []
+    for name in COMPONENTS:
+        model_path = INPUT_DIR / f"{name}.onnx"
+        if not model_path.exists():
+            print(f"\nSkipping {name}: {model_path} not found")
+            continue
+        names.append(name)
+
+    # Quantize each component; they share no state, so one worker apiece
+    with ProcessPoolExecutor(max_workers=max(1, len(names))) as ex:
+        futures = {ex.submit(quantize_file, name, q4_options): name for name in names}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"{futures[future]} quantization worker failed: {e}")
+
+    print("\n=== Final Output ===")
+    for f in sorted(OUTPUT_DIR.rglob("*")):
+        if f.is_file():
+            size_mb = f.stat().st_size / (1024 * 1024)
+            print(f"  {f.name}: {size_mb:.1f} MB")
+
+    print("\nDone!")
+
+
+if __name__ == "__main__":
+    main()
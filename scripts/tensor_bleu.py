@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Token-ID BLEU on GPU for TranslateGemma evaluation
+
+Computes per-sentence BLEU for a whole batch of (candidate, reference)
+token-id tensors at once, following the TensorBLEU approach: n-grams are
+extracted with ``unfold`` and counted against a compact per-batch dictionary
+built by ``torch.unique``, so memory scales with the n-grams actually present
+rather than vocab_size ** n.
+
+Scores are on token ids, not detokenized text, so they are meant for relative
+comparisons (e.g. quantized vs baseline with the same tokenizer), not as a
+replacement for sacrebleu in reported results.
+
+Usage:
+    from tensor_bleu import tensor_bleu
+
+    outputs = model.generate(**inputs, num_beams=1)
+    refs = tokenizer(references, padding=True, return_tensors="pt").input_ids
+    scores = tensor_bleu(outputs, refs.to(outputs.device), pad_id=tokenizer.pad_token_id)
+
+Requirements:
+    pip install torch
+"""
+
+from typing import Optional
+
+import torch
+
+
+def _ngrams(ids: torch.Tensor, n: int, pad_id: Optional[int]):
+    """Return (B, L-n+1, n) n-grams and a mask of those free of padding."""
+    if ids.size(1) < n:
+        empty = ids.new_zeros((ids.size(0), 0, n))
+        return empty, torch.zeros(empty.shape[:2], dtype=torch.bool, device=ids.device)
+
+    grams = ids.unfold(1, n, 1)
+    if pad_id is None:
+        valid = torch.ones(grams.shape[:2], dtype=torch.bool, device=ids.device)
+    else:
+        valid = (grams != pad_id).all(dim=-1)
+    return grams, valid
+
+
+def _lengths(ids: torch.Tensor, pad_id: Optional[int]) -> torch.Tensor:
+    """Number of non-padding tokens per sequence."""
+    if pad_id is None:
+        return torch.full((ids.size(0),), float(ids.size(1)), device=ids.device)
+    return (ids != pad_id).sum(dim=1).float()
+
+
+def _batched_counts(
+    inverse: torch.Tensor, valid: torch.Tensor, num_unique: int
+) -> torch.Tensor:
+    """Count compact n-gram ids per sentence with one offset bincount."""
+    batch_size = inverse.size(0)
+    offsets = torch.arange(batch_size, device=inverse.device).unsqueeze(1) * num_unique
+    flat = (inverse + offsets)[valid]
+    counts = torch.bincount(flat, minlength=batch_size * num_unique)
+    return counts.view(batch_size, num_unique)
+
+
+def tensor_bleu(
+    candidates: torch.Tensor,
+    references: torch.Tensor,
+    pad_id: Optional[int] = None,
+    max_n: int = 4,
+    floor: float = 0.1,
+) -> torch.Tensor:
+    """
+    Per-sentence BLEU for a batch of token-id sequences.
+
+    Args:
+        candidates: (B, Lc) candidate token ids, right-padded with ``pad_id``
+        references: (B, Lr) reference token ids, right-padded with ``pad_id``
+        pad_id: Padding token id excluded from n-grams and lengths
+        max_n: Highest n-gram order
+        floor: Numerator used for zero clipped counts (sacrebleu "floor" smoothing)
+
+    Returns:
+        (B,) float tensor of BLEU scores in [0, 1]
+    """
+    if candidates.size(0) != references.size(0):
+        raise ValueError("candidates and references must have the same batch size")
+
+    log_precision = torch.zeros(candidates.size(0), device=candidates.device)
+    # As in sacrebleu (without effective_order), a sentence scores 0 if it has
+    # no n-grams of some order (shorter than max_n) or no matches at all
+    has_all_orders = torch.ones(candidates.size(0), dtype=torch.bool, device=candidates.device)
+    any_match = torch.zeros_like(has_all_orders)
+
+    for n in range(1, max_n + 1):
+        cand_grams, cand_valid = _ngrams(candidates, n, pad_id)
+        ref_grams, ref_valid = _ngrams(references, n, pad_id)
+
+        # One dictionary over every n-gram in the batch, candidates and refs alike
+        num_cand = cand_grams.size(1)
+        all_grams = torch.cat([cand_grams, ref_grams], dim=1)
+        unique, inverse = torch.unique(
+            all_grams.reshape(-1, n), dim=0, return_inverse=True
+        )
+        inverse = inverse.view(all_grams.shape[:2])
+
+        cand_counts = _batched_counts(inverse[:, :num_cand], cand_valid, unique.size(0))
+        ref_counts = _batched_counts(inverse[:, num_cand:], ref_valid, unique.size(0))
+
+        clipped = torch.minimum(cand_counts, ref_counts).sum(dim=1).float()
+        total = cand_valid.sum(dim=1).float()
+        has_all_orders &= total > 0
+        any_match |= clipped > 0
+
+        clipped = torch.where(clipped > 0, clipped, torch.full_like(clipped, floor))
+        precision = clipped / total.clamp(min=1)
+        log_precision += torch.log(precision)
+
+    cand_len = _lengths(candidates, pad_id)
+    ref_len = _lengths(references, pad_id)
+
+    brevity_penalty = torch.exp(1 - ref_len / cand_len.clamp(min=1)).clamp(max=1)
+    bleu = brevity_penalty * torch.exp(log_precision / max_n)
+    return torch.where(has_all_orders & any_match, bleu, torch.zeros_like(bleu))
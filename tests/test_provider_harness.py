@@ -12,6 +12,9 @@ class HTTPError(ProviderError):
         super().__init__(f"HTTP {status}")
         self.status = status
 
+# Statuses worth trying on another provider; other 4xx would fail there too
+RETRYABLE = {408, 425, 429, 500, 502, 503, 504}
+
 class FakeProvider:
     """A minimal fake provider used by tests.
 
@@ -39,17 +42,21 @@ class ProviderRegistry:
     def __init__(self):
         self._by_name = {}
         self._by_endpoint = {}
+        # Bumped on every register so dispatchers can tell cached orders are stale
+        self.version = 0
 
     def register(self, name, provider, endpoints=None):
+        self.version += 1
         self._by_name[name] = provider
         for ep in (endpoints or []):
-            self._by_endpoint.setdefault(ep, []).append(provider)
+            # Buckets are tuples so lookups can hand them out without copying
+            self._by_endpoint[ep] = self._by_endpoint.get(ep, ()) + (provider,)
 
     def get_by_name(self, name):
         return self._by_name.get(name)
 
     def get_by_endpoint(self, endpoint):
-        return list(self._by_endpoint.get(endpoint, []))
+        return self._by_endpoint.get(endpoint, ())
 
 class Dispatcher:
     """Simple dispatcher that selects providers by request.provider or by endpoint.
@@ -60,38 +67,20 @@ class Dispatcher:
     - Deduplicate providers while preserving order.
     - Try providers in order until one successfully returns a response with the expected shape.
     - On provider exception or invalid response shape, continue to next provider.
+    - HTTPError with a status outside RETRYABLE is re-raised immediately.
     - If none succeed, raise the last encountered exception.
     """
     def __init__(self, registry):
         self.registry = registry
+        # (provider_name, endpoint) -> (registry version, ordered providers)
+        self._order_cache = {}
 
     def dispatch(self, request):
         provider_name = request.get("provider")
         endpoint = request.get("endpoint")
 
-        candidates = []
-        if provider_name:
-            p = self.registry.get_by_name(provider_name)
-            if p:
-                candidates.append(p)
-
-        candidates.extend(self.registry.get_by_endpoint(endpoint))
-
-        # Dedupe by object id to preserve registration/selection order
-        seen = set()
-        providers = []
-        for p in candidates:
-            pid = id(p)
-            if pid in seen:
-                continue
-            seen.add(pid)
-            providers.append(p)
-
-        if not providers:
-            raise ProviderError("no provider available for request")
-
         last_exc = None
-        for p in providers:
+        for p in self._provider_order(provider_name, endpoint):
             try:
                 resp = p.send(request)
                 # Validate expected response shape for these tests
@@ -99,12 +88,45 @@ class Dispatcher:
                     raise ProviderError("invalid response shape from provider")
                 return resp
             except Exception as exc:
+                if isinstance(exc, HTTPError) and exc.status not in RETRYABLE:
+                    raise
                 last_exc = exc
                 # try next provider
                 continue
 
+        # Every attempt records its exception, so none means nothing was tried
+        if last_exc is None:
+            raise ProviderError("no provider available for request")
+
         # All providers failed
-        raise last_exc or ProviderError("all providers failed")
+        raise last_exc
+
+    def _provider_order(self, provider_name, endpoint):
+        """Ordered, deduplicated providers for a request, cached until the registry changes."""
+        key = (provider_name, endpoint)
+        cached = self._order_cache.get(key)
+        if cached is not None and cached[0] == self.registry.version:
+            return cached[1]
+        providers = tuple(self._candidates(provider_name, endpoint))
+        self._order_cache[key] = (self.registry.version, providers)
+        return providers
+
+    def _candidates(self, provider_name, endpoint):
+        """Yield the named provider, then endpoint providers, skipping duplicates."""
+        # Dedupe by object id to preserve registration/selection order
+        seen = set()
+        if provider_name:
+            p = self.registry.get_by_name(provider_name)
+            if p:
+                seen.add(id(p))
+                yield p
+
+        for p in self.registry.get_by_endpoint(endpoint):
+            pid = id(p)
+            if pid in seen:
+                continue
+            seen.add(pid)
+            yield p
 
 # Tests
 
@@ -213,3 +235,39 @@ def test_failover_on_http_5xx():
 
     assert resp["provider"] == "ok"
     assert ok.last_request is not None
+
+
+def test_non_retryable_http_error_raises_immediately():
+    reg = ProviderRegistry()
+
+    class Fail400(FakeProvider):
+        def send(self, request):
+            self.last_request = request
+            raise HTTPError(400)
+
+    fail = Fail400("fail", endpoints=["/translate"])
+    ok = FakeProvider("ok", endpoints=["/translate"], response={"text": "ok"})
+    reg.register("fail", fail, ["/translate"])
+    reg.register("ok", ok, ["/translate"])
+
+    dispatcher = Dispatcher(reg)
+    with pytest.raises(HTTPError) as excinfo:
+        dispatcher.dispatch({"endpoint": "/translate"})
+
+    assert excinfo.value.status == 400
+    assert ok.last_request is None
+
+
+def test_provider_order_refreshes_after_register():
+    reg = ProviderRegistry()
+    p1 = FakeProvider("p1", endpoints=["/translate"], response={"text": "from_p1"})
+    reg.register("p1", p1, ["/translate"])
+
+    dispatcher = Dispatcher(reg)
+    req = {"provider": "p2", "endpoint": "/translate"}
+    assert dispatcher.dispatch(req)["provider"] == "p1"
+
+    p2 = FakeProvider("p2", endpoints=["/translate"], response={"text": "from_p2"})
+    reg.register("p2", p2, ["/translate"])
+
+    assert dispatcher.dispatch(req)["provider"] == "p2"
@@ -0,0 +1,56 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+torch = pytest.importorskip("torch")
+sacrebleu = pytest.importorskip("sacrebleu")
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "scripts"))
+from tensor_bleu import tensor_bleu  # noqa: E402
+
+PAD = 0
+
+# (candidate, reference) token ids; covers exact, partial, no-match, short
+# (fewer than 4 tokens) and empty candidates
+PAIRS = [
+    ([5, 6, 7, 8, 9], [5, 6, 7, 8, 9]),
+    ([5, 6, 7, 8, 9, 10], [5, 6, 7, 11, 9, 10, 12]),
+    ([3, 3, 3, 3, 3], [3, 3]),
+    ([1, 2, 3, 4, 5], [6, 7, 8]),
+    ([1, 2], [1, 2, 3, 4, 5, 6]),
+    ([1], [1]),
+    ([], [1, 2, 3]),
+]
+
+
+def _pad(seqs):
+    width = max(1, max(len(s) for s in seqs))
+    return torch.tensor([s + [PAD] * (width - len(s)) for s in seqs])
+
+
+def _sacrebleu(candidate, reference):
+    bleu = sacrebleu.metrics.BLEU(tokenize="none", smooth_method="floor", smooth_value=0.1)
+    score = bleu.sentence_score(" ".join(map(str, candidate)), [" ".join(map(str, reference))])
+    return score.score / 100
+
+
+def test_matches_sacrebleu_on_token_ids():
+    scores = tensor_bleu(
+        _pad([c for c, _ in PAIRS]), _pad([r for _, r in PAIRS]), pad_id=PAD
+    )
+
+    for (candidate, reference), score in zip(PAIRS, scores.tolist()):
+        assert score == pytest.approx(_sacrebleu(candidate, reference), abs=1e-5)
+
+
+def test_all_pad_rows_score_zero():
+    candidates = torch.tensor([[PAD, PAD, PAD], [4, 5, 6]])
+    references = torch.tensor([[4, 5, 6], [PAD, PAD, PAD]])
+
+    assert tensor_bleu(candidates, references, pad_id=PAD).tolist() == [0.0, 0.0]
+
+
+def test_batch_size_mismatch_raises():
+    with pytest.raises(ValueError):
+        tensor_bleu(torch.ones(2, 3, dtype=torch.long), torch.ones(1, 3, dtype=torch.long))